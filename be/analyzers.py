@@ -3,56 +3,46 @@ import inspect
 import logging
 from datetime import datetime, timedelta
 from config import ConfigSection
-from datastore import KillMail, LossMailAttributes, Location
-from staticdata import InvType, InvGroup, InvCategory, InvFlag, DgmAttributeTypes, DgmEffects, MapSolarSystem
+from datastore import KillMail, LossMailAttributes, Location, Session
+from staticdata import InvType, InvGroup, InvCategory, InvFlag, MapSolarSystem, DogmaIndex, jump_graph
 
 _config = ConfigSection('analyzers')
 _log = logging.getLogger('sound.srp.be.analyzers')
 
 class EmptySlotsAnalyzer(object):
 
-    lowSlotsAttribute = DgmAttributeTypes.by_name('lowSlots')
-    medSlotsAttribute = DgmAttributeTypes.by_name('medSlots')
-    highSlotsAttribute = DgmAttributeTypes.by_name('hiSlots')
-    rigSlotsAttribute = DgmAttributeTypes.by_name('rigSlots')
-    turretsAttribute = DgmAttributeTypes.by_name('turretSlotsLeft')
-    launchersAttribute = DgmAttributeTypes.by_name('launcherSlotsLeft')
-    turretsEffect = DgmEffects.by_name('turretFitted')
-    launchersEffect = DgmEffects.by_name('launcherFitted')
-    shipCalibrationAttribute = DgmAttributeTypes.by_name('upgradeCapacity')
-    rigCalibrationAttribute = DgmAttributeTypes.by_name('upgradeCost')
+    dogma = DogmaIndex(['lowSlots', 'medSlots', 'hiSlots', 'rigSlots', 'turretSlotsLeft', 'launcherSlotsLeft',
+            'upgradeCapacity', 'upgradeCost'], ['turretFitted', 'launcherFitted'])
+
+    lowSlotFlags = [InvFlag.by_name('LoSlot%d' % i).flagID for i in range(8)]
+    medSlotFlags = [InvFlag.by_name('MedSlot%d' % i).flagID for i in range(8)]
+    highSlotFlags = [InvFlag.by_name('HiSlot%d' % i).flagID for i in range(8)]
+    rigSlotFlags = [InvFlag.by_name('RigSlot%d' % i).flagID for i in range(8)]
 
     def process(self, kill, loss):
         _log.debug('Analyzing empty slots for kill: %d' % kill.kill_id)
-        lowSlots = EmptySlotsAnalyzer.lowSlotsAttribute.for_type_id(kill.victim.ship_type_id)
-        medSlots = EmptySlotsAnalyzer.medSlotsAttribute.for_type_id(kill.victim.ship_type_id)
-        highSlots = EmptySlotsAnalyzer.highSlotsAttribute.for_type_id(kill.victim.ship_type_id)
-        rigSlots = EmptySlotsAnalyzer.rigSlotsAttribute.for_type_id(kill.victim.ship_type_id)
-        turretSlots = EmptySlotsAnalyzer.turretsAttribute.for_type_id(kill.victim.ship_type_id)
-        launcherSlots = EmptySlotsAnalyzer.launchersAttribute.for_type_id(kill.victim.ship_type_id)
-        shipCalibration = EmptySlotsAnalyzer.shipCalibrationAttribute.for_type_id(kill.victim.ship_type_id)
-
-        lowSlotFlags = [InvFlag.by_name('LoSlot%d' % i).flagID for i in range(8)]
-        medSlotFlags = [InvFlag.by_name('MedSlot%d' % i).flagID for i in range(8)]
-        highSlotFlags = [InvFlag.by_name('HiSlot%d' % i).flagID for i in range(8)]
-        rigSlotFlags = [InvFlag.by_name('RigSlot%d' % i).flagID for i in range(8)]
-
-        lowSlotItems = [i for i in kill.items if i.flag_id in lowSlotFlags]
-        medSlotItems = [i for i in kill.items if i.flag_id in medSlotFlags]
-        highSlotItems = [i for i in kill.items if i.flag_id in highSlotFlags]
-        rigSlotItems = [i for i in kill.items if i.flag_id in rigSlotFlags]
-
-        turrets = [i for i in highSlotItems
-                if EmptySlotsAnalyzer.turretsEffect.for_type_id(i.type_id) is not None]
-        launchers = [i for i in highSlotItems
-                if EmptySlotsAnalyzer.launchersEffect.for_type_id(i.type_id) is not None]
-        rigsCalibration = sum([EmptySlotsAnalyzer.rigCalibrationAttribute.for_type_id(i.type_id)
-                for i in rigSlotItems])
-
-        loss.empty_low_slots = len(lowSlotItems) < lowSlots
-        loss.empty_med_slots = len(medSlotItems) < medSlots
-        loss.empty_rig_slots = len(rigSlotItems) < rigSlots and rigsCalibration < shipCalibration
-        loss.empty_hardpoints = len(turrets) < turretSlots and len(launchers) < launcherSlots
+        dogma = EmptySlotsAnalyzer.dogma
+        ship_type_id = kill.victim.ship_type_id
+        lowSlots = dogma.attribute('lowSlots', ship_type_id)
+        medSlots = dogma.attribute('medSlots', ship_type_id)
+        rigSlots = dogma.attribute('rigSlots', ship_type_id)
+        turretSlots = dogma.attribute('turretSlotsLeft', ship_type_id)
+        launcherSlots = dogma.attribute('launcherSlotsLeft', ship_type_id)
+        shipCalibration = dogma.attribute('upgradeCapacity', ship_type_id)
+
+        lowSlotItems = [i.type_id for i in kill.items if i.flag_id in EmptySlotsAnalyzer.lowSlotFlags]
+        medSlotItems = [i.type_id for i in kill.items if i.flag_id in EmptySlotsAnalyzer.medSlotFlags]
+        highSlotItems = [i.type_id for i in kill.items if i.flag_id in EmptySlotsAnalyzer.highSlotFlags]
+        rigSlotItems = [i.type_id for i in kill.items if i.flag_id in EmptySlotsAnalyzer.rigSlotFlags]
+
+        turrets = sum(dogma.has_effects('turretFitted', highSlotItems))
+        launchers = sum(dogma.has_effects('launcherFitted', highSlotItems))
+        rigsCalibration = sum(dogma.attributes('upgradeCost', rigSlotItems))
+
+        loss.empty_low_slots = bool(len(lowSlotItems) < lowSlots)
+        loss.empty_med_slots = bool(len(medSlotItems) < medSlots)
+        loss.empty_rig_slots = bool(len(rigSlotItems) < rigSlots and rigsCalibration < shipCalibration)
+        loss.empty_hardpoints = bool(turrets < turretSlots and launchers < launcherSlots)
 
 class ModulesAnalyzer(object):
 
@@ -121,8 +111,8 @@ class ContextAnalyzer(object):
         _log.debug('Analyzing context for kill: %d' % kill.kill_id)
         back_minutes = long(_config.get_option('context_minutes_back'))
         forward_minutes = long(_config.get_option('context_minutes_forward'))
-        systems = [system.solarSystemID for system in MapSolarSystem.by_id(kill.solar_system_id).neighbours]
-        systems.insert(0, kill.solar_system_id)
+        jumps = int(_config.get_option('context_jumps') or 1)
+        systems = jump_graph().within(kill.solar_system_id, jumps).keys()
         related = kill.related_kills(back_minutes, forward_minutes, systems)
         for rkill in related:
             if rkill.kill_id == kill.kill_id:
@@ -159,33 +149,34 @@ def run():
             InvGroup.by_name('Shuttle').groupID,
             InvGroup.by_name('Rookie Ship').groupID
         ]
-    for kill in get_losses():
-        ship = InvType.by_id(kill.victim.ship_type_id)
-        if ship.groupID in skip_groups:
-            _log.info('Skipping %s %d' % (kill.victim.ship_class, kill.kill_id))
-            continue
-        if ship.group.categoryID != ship_category:
-            _log.info('Skipping non-ship %d' % kill.kill_id)
-            continue
-        loss = LossMailAttributes(kill.kill_id)
-        age = (datetime.utcnow() - kill.kill_time).total_seconds()
-        if loss.ship_type_id is None:
-            loss.ship_type_id = kill.victim.ship_type_id
-            loss.ship_group_id = ship.groupID
-            loss.character_id = kill.victim.character_id
-            loss.region_name = kill.region_name
-        elif age > (forward_minutes + 60) * 60 and not force:
-            # For now, don't re-analyze losses from more than forward_minutes plus an hour ago
-            # that have already been analyzed.
-            _log.info('Skipping already analyzed loss %d' % kill.kill_id)
-            continue
-        _log.info('Analyzing loss %s (%d) from %s.' % (kill, kill.kill_id, kill.kill_time))
-        if not kill.items:
-            kill.items = []
-        for analyzer in analyzers:
-            if analyzer.process:
-                analyzer.process(kill, loss)
-        loss.save()
+    with Session():
+        for kill in get_losses():
+            ship = InvType.by_id(kill.victim.ship_type_id)
+            if ship.groupID in skip_groups:
+                _log.info('Skipping %s %d' % (kill.victim.ship_class, kill.kill_id))
+                continue
+            if ship.group.categoryID != ship_category:
+                _log.info('Skipping non-ship %d' % kill.kill_id)
+                continue
+            loss = LossMailAttributes(kill.kill_id)
+            age = (datetime.utcnow() - kill.kill_time).total_seconds()
+            if loss.ship_type_id is None:
+                loss.ship_type_id = kill.victim.ship_type_id
+                loss.ship_group_id = ship.groupID
+                loss.character_id = kill.victim.character_id
+                loss.region_name = kill.region_name
+            elif age > (forward_minutes + 60) * 60 and not force:
+                # For now, don't re-analyze losses from more than forward_minutes plus an hour ago
+                # that have already been analyzed.
+                _log.info('Skipping already analyzed loss %d' % kill.kill_id)
+                continue
+            _log.info('Analyzing loss %s (%d) from %s.' % (kill, kill.kill_id, kill.kill_time))
+            if not kill.items:
+                kill.items = []
+            for analyzer in analyzers:
+                if analyzer.process:
+                    analyzer.process(kill, loss)
+            loss.save()
 
 if __name__ == '__main__':
     run()
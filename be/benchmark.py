@@ -0,0 +1,166 @@
+import os
+import sys
+import logging
+import subprocess
+import time
+import timeit
+import googledatastore
+from datetime import datetime
+import datastore
+from datastore import KillMail, Victim, Attacker, Item, PaymentDetail
+
+_log = logging.getLogger('sound.srp.be.benchmark')
+
+def make_kill(attackers, items):
+    """ Builds a killmail shaped like a big fight loss, with the given number of attackers and items. """
+
+    kill = KillMail()
+    kill.kill_id = 50000000
+    kill.kill_time = datetime(2015, 6, 1, 12, 30, 15)
+    kill.solar_system_id = 30000142
+    kill.solar_system_name = u'Jita'
+    kill.region_name = u'The Forge'
+    kill.loss_mail = True
+    kill.victim = Victim()
+    kill.victim.character_id = 90000001
+    kill.victim.character_name = u'Victim'
+    kill.victim.corporation_id = 98000001
+    kill.victim.corporation_name = u'Victim Corp'
+    kill.victim.ship_type_id = 24690
+    kill.victim.ship_name = u'Vulture'
+    kill.victim.damage_taken = 123456
+    for i in range(attackers):
+        a = Attacker()
+        a.character_id = 91000000 + i
+        a.character_name = u'Attacker %d' % i
+        a.corporation_id = 98100000 + i % 20
+        a.corporation_name = u'Corp %d' % (i % 20)
+        a.alliance_id = 99000001
+        a.alliance_name = u'Alliance'
+        a.damage_done = 100 + i
+        a.final_blow = i == 0
+        a.security_status = -1.5
+        a.ship_type_id = 11987
+        a.ship_name = u'Guardian'
+        a.weapon_type_id = 2929
+        a.weapon_name = u'425mm AutoCannon II'
+        kill.attackers.append(a)
+    kill.final_blow = kill.attackers[0] if attackers else None
+    flags = [u'HiSlot%d' % (i % 8) for i in range(8)] + [u'MedSlot%d' % (i % 8) for i in range(8)] + \
+            [u'LoSlot%d' % (i % 8) for i in range(8)] + [u'Cargo'] * 8
+    for i in range(items):
+        item = Item()
+        item.type_id = 2000 + i
+        item.flag_id = 27 + i % 32
+        item.qty_dropped = i % 2
+        item.qty_destroyed = 1 - i % 2
+        item.singleton = False
+        item.type_name = u'Item %d' % i
+        item.group_name = u'Group'
+        item.category_name = u'Module'
+        item.flag_name = flags[i % len(flags)]
+        item.bpc = False
+        item.value = 1000000.0 + i
+        kill.items.append(item)
+    kill.payments = [PaymentDetail(1, kill.kill_id, 100)]
+    kill.srp_amount = 100
+    kill.paid_amount = 100
+    return kill
+
+def measure(name, fn, number):
+    seconds = min(timeit.repeat(fn, number = number, repeat = 3)) / number
+    print '%-40s %10.3f ms' % (name, seconds * 1000)
+    return seconds
+
+def measure_process(name, fn, number):
+    seconds = min(fn() for _ in range(number))
+    print '%-40s %10.3f ms' % (name, seconds * 1000)
+    return seconds
+
+def import_seconds(module):
+    """ Returns how long a new interpreter takes to import module. """
+
+    env = dict(os.environ, PYTHONPATH = os.pathsep.join(filter(None,
+            [os.path.dirname(os.path.abspath(__file__)), os.environ.get('PYTHONPATH')])))
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', 'import %s' % module], env = env)
+    return time.time() - start
+
+def startup(number):
+    """ Compares importing staticdata with and without its cache of reflected tables. """
+
+    import staticdata
+    from sqlalchemy import MetaData, Table
+    names = sorted(staticdata.metadata.tables)
+    path = staticdata._metadata_cache
+    print 'Static data: %d tables, reflection cached in %s.' % (len(names), path)
+
+    def reflect():
+        reflected = MetaData(bind = staticdata.engine)
+        for name in names:
+            Table(name, reflected, autoload = True)
+    def load():
+        staticdata._load_metadata(path, staticdata._schema_key())
+    before = measure('reflect tables', reflect, number)
+    after = measure('load cached tables', load, number)
+    print '%-40s %10.1fx' % ('reflection speedup', before / after)
+
+    def cold():
+        if os.path.exists(path):
+            os.remove(path)
+        return import_seconds('staticdata')
+    measure_process('python', lambda: import_seconds('sys'), number)
+    before = measure_process('import staticdata, no cache', cold, number)
+    after = measure_process('import staticdata, cached', lambda: import_seconds('staticdata'), number)
+    print '%-40s %10.3f ms' % ('saved per job', (before - after) * 1000)
+
+def run():
+    attackers = 500
+    items = 150
+    number = 20
+    if '-a' in sys.argv:
+        attackers = int(sys.argv[sys.argv.index('-a') + 1])
+    if '-i' in sys.argv:
+        items = int(sys.argv[sys.argv.index('-i') + 1])
+    if '-n' in sys.argv:
+        number = int(sys.argv[sys.argv.index('-n') + 1])
+    if 'startup' in sys.argv:
+        startup(number)
+        return
+    kill = make_kill(attackers, items)
+    entity = kill._get_entity()
+    print 'KillMail with %d attackers and %d items, %d bytes encoded.' % (
+            attackers, items, entity.ByteSize())
+
+    def decode_generic():
+        datastore._set_entity_generic(KillMail(), entity)
+    def decode_compiled():
+        datastore._codec(KillMail).decode(KillMail(), entity)
+    def decode_lazy():
+        KillMail()._set_entity(entity)
+    def decode_lazy_victim():
+        k = KillMail()
+        k._set_entity(entity)
+        k.victim
+
+    before = measure('encode, generic', lambda: datastore._get_entity_generic(kill), number)
+    after = measure('encode, declared fields', lambda: kill._get_entity(), number)
+    print '%-40s %10.1fx' % ('encode speedup', before / after)
+    before = measure('decode, generic', decode_generic, number)
+    after = measure('decode, declared fields', decode_compiled, number)
+    print '%-40s %10.1fx' % ('decode speedup', before / after)
+    measure('load, sub entities left undecoded', decode_lazy, number)
+    measure('load, victim decoded', decode_lazy_victim, number)
+
+    codec = datastore._Codec(KillMail)
+    codec.packed = frozenset(KillMail._packed)
+    packed = googledatastore.Entity()
+    codec.encode(kill, packed)
+    print 'Packed %s: %d bytes encoded.' % (', '.join(KillMail._packed), packed.ByteSize())
+    def decode_packed():
+        codec.decode(KillMail(), packed)
+    measure('encode, packed', lambda: codec.encode(kill, googledatastore.Entity()), number)
+    measure('decode, packed', decode_packed, number)
+
+if __name__ == '__main__':
+    run()
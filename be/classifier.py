@@ -2,7 +2,7 @@ import sys
 import logging
 from datetime import datetime, timedelta
 from config import ConfigSection
-from datastore import KillMail, LossMailAttributes
+from datastore import KillMail, LossMailAttributes, Session
 from staticdata import InvType, InvGroup
 
 _config = ConfigSection('classifier')
@@ -47,8 +47,9 @@ common_ratting_ships = [
     InvType.by_name('Loki')
     ]
 
-def process(kill):
-    loss = LossMailAttributes(kill.kill_id)
+def process(kill, loss = None):
+    if loss is None:
+        loss = LossMailAttributes(kill.kill_id)
     if loss.ship_type_id is None:
         return
     if loss.ship_type_id in exploration_ships and loss.exploration_mods:
@@ -85,8 +86,13 @@ def run():
     look_back_days = int(_config.get_option('look_back_days'))
     _log.info('Classifying killmails for the past %d days.' % look_back_days)
     start_time = datetime.now() - timedelta(look_back_days)
-    for kill in KillMail.losses_after(start_time):
-        process(kill)
+    with Session():
+        # Only load the killmails that have been analyzed, using their attributes loaded in batches.
+        ids = list(KillMail.losses_after(start_time).ids())
+        losses = { loss.kill_id: loss for loss in LossMailAttributes.load_multi(ids) }
+        ids = [id for id in ids if id in losses and losses[id].ship_type_id is not None]
+        for kill in KillMail.load_multi(ids):
+            process(kill, losses[kill.kill_id])
 
 if __name__ == '__main__':
     run()
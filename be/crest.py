@@ -4,7 +4,7 @@ import market
 import valuer
 import web
 from config import ConfigSection
-from datastore import KillMail, Victim, Attacker, Item, GroupedItems, ShipClass
+from datastore import KillMail, Victim, Attacker, Item, ShipClass
 from datetime import datetime
 from staticdata import InvType, InvFlag, MapSolarSystem
 
@@ -119,8 +119,18 @@ def convert_item(item):
     i.flag_name = flag.flagName if flag is not None else 'Unknown'
     return i
 
+def prefetch_static_data(kill):
+    """ Loads the item types and flags of a kill in a few queries, so that converting it finds them
+    in the static data caches.
+    """
+
+    items = kill.get('items') or kill['victim'].get('items') or []
+    InvType.by_ids([item['itemType']['id'] for item in items] + [kill['victim']['shipType']['id']])
+    InvFlag.by_ids(item['flag'] for item in items)
+
 def import_kill(kill):
     kill = get_killmail(kill)
+    prefetch_static_data(kill)
     km = KillMail(kill['killID'])
     _log.debug('Converting killmail %d.' % km.kill_id)
     km.kill_time = datetime.strptime(kill['killTime'], '%Y.%m.%d %H:%M:%S')
@@ -138,7 +148,6 @@ def import_kill(kill):
         km.items = map(convert_item, kill['items'])
     elif 'items' in kill['victim']:
         km.items = map(convert_item, kill['victim']['items'])
-    km.grouped_items = GroupedItems(km.items)
     km.loss_mail = km.victim.alliance_id == alliance_id
     ship_class = ShipClass(km.victim.ship_class)
     if km.default_payment is None:
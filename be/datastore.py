@@ -1,97 +1,874 @@
 import googledatastore
 import logging
-import calendar
 import sha
+import sys
+import time
+import os
+import re
+import atexit
+import heapq
+import bisect
+import copy
+import threading
+import Queue
+import json
+import zlib
+from collections import OrderedDict, deque
 from googledatastore.helper import *
-from datetime import datetime
+from datetime import datetime, timedelta
 from config import ConfigSection
 
 _config = ConfigSection('datastore')
 _log = logging.getLogger('sound.be.datastore')
 googledatastore.set_options(dataset = _config.get_option('dataset'))
+# 'single' writes each batch with one non-transactional insert / update commit.
+# 'transactional' looks each batch up in a transaction first to find out which entities are new.
+_save_protocol = _config.get_option('save_protocol') or 'single'
+# Write the sub entity fields a class lists in _packed as one compressed blob, see _pack().
+# Packed fields are always readable, whatever this is set to.
+_pack_sub_entities = bool(_config.get_option('pack_sub_entities'))
+# Prometheus textfile the RPC stats are written to at exit, if set.
+_metrics_file = _config.get_option('rpc_metrics_file')
+
+def _int_option(name, default):
+    value = _config.get_option(name)
+    return int(value) if value else default
+
+# Batch budgets, kept under the Cloud Datastore API limits of 1000 keys per lookup, 500 mutations
+# per commit and 10MB per request.
+_lookup_batch_keys = _int_option('lookup_batch_keys', 1000)
+_commit_batch_mutations = _int_option('commit_batch_mutations', 500)
+_commit_batch_bytes = _int_option('commit_batch_bytes', 8 * 1024 * 1024)
+# Transactions can only touch 25 entity groups.
+_transaction_batch_keys = 25
+# Attempts at a read-modify-write transaction that keeps losing to other writers.
+_transaction_attempts = 3
+_query_page_size = _int_option('query_page_size', 100)
+# Integer ids further apart than this are checked for existence with separate key range queries.
+_exists_range_gap = _int_option('exists_range_gap', 100000)
+
+# Fields that are set by save() itself and so are ignored when checking for changes.
+_timestamp_fields = frozenset(['created_time', 'modified_time'])
+
+def _canonical(val):
+    """ Get a representation of a field value that only depends on what would be stored.
+
+    None values and empty lists are not stored, str and unicode are stored the same way, and so are
+    int and long.
+    """
+
+    if isinstance(val, _BaseEntity):
+        return tuple(sorted((key, _canonical(v)) for key, v in val._field_items()
+                if v is not None and v != []))
+    elif isinstance(val, list):
+        return tuple(_canonical(v) for v in val if v is not None)
+    elif type(val) is str:
+        return unicode(val)
+    elif type(val) is int:
+        return long(val)
+    return val
+
+def _digest(val):
+    return sha.new(repr(_canonical(val))).digest()
+
+def _set_string(value_proto, val):
+    value_proto.string_value = val
+
+def _set_str(value_proto, val):
+    value_proto.string_value = unicode(val)
+
+def _set_boolean(value_proto, val):
+    value_proto.boolean_value = val
+
+def _set_integer(value_proto, val):
+    value_proto.integer_value = val
+
+def _set_double(value_proto, val):
+    value_proto.double_value = val
+
+def _set_timestamp(value_proto, val):
+    value_proto.timestamp_microseconds_value = to_timestamp_usec(val)
+
+def _set_list(value_proto, val):
+    # Marks the value as set, so an empty list is still stored as an empty value.
+    value_proto.Clear()
+    for e in val:
+        if e is None:
+            continue
+        sub_value = value_proto.list_value.add()
+        if isinstance(e, _BaseEntity):
+            _codec(type(e)).encode(e, sub_value.entity_value)
+            sub_value.indexed = False
+        else:
+            set_value(sub_value, e, False)
+
+# Value setters by the exact type of the field value, used by the compiled encoders.
+# Strings are always stored as unicode text and lists are stored unindexed.
+_setters = {
+    unicode: _set_string,
+    str: _set_str,
+    bool: _set_boolean,
+    int: _set_integer,
+    long: _set_integer,
+    float: _set_double,
+    datetime: _set_timestamp,
+    list: _set_list
+}
+
+def _encode_value(value_proto, val):
+    setter = _setters.get(type(val))
+    if setter is not None:
+        setter(value_proto, val)
+    elif isinstance(val, _BaseEntity):
+        _codec(type(val)).encode(val, value_proto.entity_value)
+        value_proto.indexed = False
+    else:
+        set_value(value_proto, val)
+
+# Value fields read for each declared field type, used by the compiled decoders.
+_value_fields = {
+    unicode: 'string_value',
+    bool: 'boolean_value',
+    int: 'integer_value',
+    long: 'integer_value',
+    float: 'double_value'
+}
+
+def _scalar_decoder(field):
+    def decode(value_proto):
+        if value_proto.HasField(field):
+            return getattr(value_proto, field)
+        return get_value(value_proto)
+    return decode
+
+def _decode_timestamp(value_proto):
+    if value_proto.HasField('timestamp_microseconds_value'):
+        return from_timestamp_usec(value_proto.timestamp_microseconds_value)
+    return get_value(value_proto)
+
+# Start of a packed sub entity field, the last byte is the format version.
+# The frontend model reads the same format, see fe/model.py.
+_PACKED_HEADER = 'SRPK\x01'
+
+def _pack_value(val):
+    if isinstance(val, _BaseEntity):
+        packed = _pack_entities(type(val), [val])
+        packed['one'] = 1
+        return packed
+    elif isinstance(val, list):
+        entities = [e for e in val if e is not None]
+        if entities and isinstance(entities[0], _BaseEntity):
+            return _pack_entities(type(entities[0]), entities)
+        return [_pack_value(e) for e in entities]
+    elif type(val) is str:
+        return unicode(val)
+    return val
+
+def _pack_entities(cls, entities):
+    names = _codec(cls).names
+    return {
+        'f': names,
+        'r': [[_pack_value(getattr(e, name, None)) for name in names] for e in entities]
+    }
+
+def _pack(val):
+    """ Packs a sub entity or list of sub entities into a compressed blob.
+
+    The blob is the header followed by zlib compressed JSON. Entities are written as the list of
+    field names under 'f' and a row of field values per entity under 'r', nested sub entities are
+    written the same way. A single entity rather than a list is marked with 'one'.
+    """
+
+    return _PACKED_HEADER + zlib.compress(json.dumps(_pack_value(val), separators = (',', ':')))
+
+def _unpack_value(cls, packed):
+    if isinstance(packed, list):
+        # An empty list, which has no field names.
+        return packed
+    codec = _codec(cls)
+    names = [str(name) for name in packed['f']]
+    entities = []
+    for row in packed['r']:
+        e = cls()
+        for name, val in zip(names, row):
+            if isinstance(val, dict) and name in codec.sub_entities:
+                val = _unpack_value(codec.sub_entities[name], val)
+            try:
+                setattr(e, name, val)
+            except AttributeError:
+                _log.debug('Skipping unknown %s property %s.', cls.__name__, name)
+        entities.append(e)
+    if packed.get('one'):
+        return entities[0]
+    return entities
+
+def _unpack(cls, data):
+    """ Unpacks a blob written by _pack() into entities of type cls. """
+
+    return _unpack_value(cls, json.loads(zlib.decompress(data[len(_PACKED_HEADER):])))
+
+def _set_packed(value_proto, val):
+    value_proto.blob_value = _pack(val)
+    value_proto.indexed = False
+
+def _entity_decoder(cls):
+    def decode(value_proto):
+        if value_proto.HasField('blob_value') and value_proto.blob_value.startswith(_PACKED_HEADER):
+            return _unpack(cls, value_proto.blob_value)
+        if value_proto.HasField('entity_value'):
+            e = cls()
+            _codec(cls).decode(e, value_proto.entity_value)
+            return e
+        if value_proto.list_value:
+            return [decode(sub_value) for sub_value in value_proto.list_value]
+        return get_value(value_proto)
+    return decode
+
+class _Codec(object):
+    """ Encoder and decoder for one entity class, compiled from the _fields it declares.
+
+    Each entry of _fields is a (name, type) pair. The type is int, long, unicode, bool, float,
+    datetime or list for simple values, an entity class for a sub entity, or a one item list
+    holding an entity class for a list of sub entities. Fields are collected from the whole class
+    hierarchy. Values that do not match the declared type, and attributes that are not declared,
+    are handled the generic way.
+    """
+
+    def __init__(self, cls):
+        self.names = []
+        self.decoders = dict()
+        self.sub_entities = dict()
+        for klass in reversed(cls.__mro__):
+            fields = klass.__dict__.get('_fields', ())
+            if not all(isinstance(field, tuple) and len(field) == 2 for field in fields):
+                # Usually a one field declaration written without its trailing comma.
+                raise TypeError('%s._fields must be a tuple of (name, type) pairs.' % klass.__name__)
+            for name, kind in fields:
+                if name not in self.decoders:
+                    self.names.append(name)
+                if isinstance(kind, list):
+                    kind = kind[0]
+                if isinstance(kind, type) and issubclass(kind, _BaseEntity):
+                    self.sub_entities[name] = kind
+                    self.decoders[name] = _entity_decoder(kind)
+                elif kind is datetime:
+                    self.decoders[name] = _decode_timestamp
+                elif kind in _value_fields:
+                    self.decoders[name] = _scalar_decoder(_value_fields[kind])
+                else:
+                    self.decoders[name] = get_value
+        self.declared = frozenset(self.names)
+        self.slotted = '__dict__' not in dir(cls)
+        self.packed = frozenset(cls._packed) if _pack_sub_entities else frozenset()
+
+    def encode(self, obj, entity, skip = ()):
+        """ Adds the stored fields of obj to the entity, apart from the names in skip. """
+
+        for name in self.names:
+            if name in skip:
+                continue
+            val = getattr(obj, name, None)
+            if val is not None:
+                prop = entity.property.add()
+                prop.name = name
+                if name in self.packed:
+                    _set_packed(prop.value, val)
+                else:
+                    _encode_value(prop.value, val)
+        if self.slotted:
+            return
+        for name, val in obj.__dict__.iteritems():
+            if val is not None and name not in self.declared and not name.startswith('_'):
+                prop = entity.property.add()
+                prop.name = name
+                _encode_value(prop.value, val)
+
+    def decode_property(self, obj, prop):
+        """ Sets the field of obj stored in the property. """
+
+        decoder = self.decoders.get(prop.name, get_value)
+        try:
+            setattr(obj, prop.name, decoder(prop.value))
+        except AttributeError:
+            # Entities with __slots__ only hold the fields they declare.
+            _log.debug('Skipping unknown %s property %s.', type(obj).__name__, prop.name)
+
+    def decode(self, obj, entity):
+        """ Sets the fields of obj from the entity. """
+
+        for prop in entity.property:
+            self.decode_property(obj, prop)
+
+_codecs = dict()
+
+def _codec(cls):
+    codec = _codecs.get(cls)
+    if codec is None:
+        codec = _codecs[cls] = _Codec(cls)
+    return codec
+
+def _get_entity_generic(obj):
+    """ Encodes an entity by inspecting each value, without using the declared fields.
+
+    This is how entities were encoded before fields were declared, and is kept as the reference for
+    benchmark.py.
+    """
+
+    entity = googledatastore.Entity()
+    simple_attrs = dict()
+    complex_attrs = dict()
+    def process_entity(e):
+        if isinstance(e, _BaseEntity):
+            return _get_entity_generic(e)
+        elif isinstance(e, list):
+            return [process_entity(s) for s in e if s is not None]
+        else:
+            return e
+    for key, val in obj._field_items():
+        if type(val) is str:
+            val = unicode(val)
+        if isinstance(val, _BaseEntity):
+            complex_attrs[key] = _get_entity_generic(val)
+        elif isinstance(val, list):
+            complex_attrs[key] = [process_entity(e) for e in val if e is not None]
+        elif val is not None:
+            simple_attrs[key] = val
+    add_properties(entity, simple_attrs, indexed = True)
+    add_properties(entity, complex_attrs, indexed = False)
+    return entity
+
+def _set_entity_generic(obj, entity):
+    """ Decodes an entity by inspecting each value, the counterpart of _get_entity_generic(). """
+
+    def process_entity(entity, cls):
+        if isinstance(entity, list):
+            return [process_entity(e, cls) for e in entity]
+        else:
+            e = cls()
+            _set_entity_generic(e, entity)
+            return e
+    attrs = { key: get_value(val) for (key, val) in get_property_dict(entity).iteritems() }
+    for name, cls in obj._sub_entities().iteritems():
+        if name in attrs and attrs[name]:
+            attrs[name] = process_entity(attrs[name], cls)
+    for key, val in attrs.iteritems():
+        try:
+            setattr(obj, key, val)
+        except AttributeError:
+            pass
+
+# Snapshot digest of a sub entity field that is still held undecoded, and so cannot have changed.
+_UNDECODED = object()
+
+def _make_key(kind, id):
+    key = googledatastore.Key()
+    path = key.path_element.add()
+    path.kind = kind
+    if isinstance(id, basestring):
+        path.name = id
+    else:
+        path.id = id
+    return key
+
+def _key_id(key):
+    path = key.path_element[-1]
+    return path.name if path.HasField('name') else path.id
+
+def _id_ranges(ids, max_gap):
+    """ Groups sorted integer ids into [first, last] ranges with no gap larger than max_gap. """
+
+    ranges = []
+    for id in ids:
+        if ranges and id - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = id
+        else:
+            ranges.append([id, id])
+    return ranges
+
+# Upper bounds in seconds of the RPC latency histogram buckets.
+_latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_context = threading.local()
+
+def _caller():
+    """ Names the datastore method that an RPC is made for.
+
+    This is the outermost public function of this module on the stack, like save, load_multi or
+    losses_after, or the function that called into this module if there is none.
+    """
+
+    frame = sys._getframe(1)
+    name = None
+    module = globals()
+    while frame is not None and frame.f_globals is module:
+        code_name = frame.f_code.co_name
+        if not code_name.startswith('_') and not code_name.startswith('<'):
+            name = code_name
+        frame = frame.f_back
+    if name is None and frame is not None:
+        name = '%s.%s' % (frame.f_globals.get('__name__'), frame.f_code.co_name)
+    return name
+
+def _request_kind(method, req):
+    if method == 'lookup':
+        keys = req.key
+    elif method == 'commit':
+        mutation = req.mutation
+        keys = [entity.key for entity in (mutation.insert or mutation.update or mutation.upsert)]
+        keys = keys or mutation.delete
+    elif method == 'run_query':
+        match = re.search(r'FROM (\w+)', req.gql_query.query_string)
+        if match:
+            return match.group(1)
+        return req.query.kind[0].name if req.query.kind else '-'
+    else:
+        return '-'
+    return keys[0].path_element[-1].kind if keys else '-'
+
+def _response_keys(method, req, resp):
+    if method == 'lookup':
+        return len(resp.found) + len(resp.missing)
+    if method == 'commit':
+        mutation = req.mutation
+        return len(mutation.insert) + len(mutation.update) + len(mutation.upsert) + len(mutation.delete)
+    if method == 'run_query':
+        return len(resp.batch.entity_result)
+    return 0
+
+class _RpcStats(object):
+    """ Counts, latency histograms, keys and bytes of datastore RPCs by method, kind and call site. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, method, kind, site, seconds, keys, sent, received, failed):
+        bucket = bisect.bisect_left(_latency_buckets, seconds)
+        with self._lock:
+            stats = self._stats.get((method, kind, site))
+            if stats is None:
+                stats = self._stats[(method, kind, site)] = [0, 0, 0.0, 0, 0, 0, [0] * (len(_latency_buckets) + 1)]
+            stats[0] += 1
+            stats[1] += failed
+            stats[2] += seconds
+            stats[3] += keys
+            stats[4] += sent
+            stats[5] += received
+            stats[6][bucket] += 1
+
+    def report(self):
+        """ Logs a summary of the RPCs made and writes the rpc_metrics_file if one is configured. """
+
+        with self._lock:
+            stats = sorted(self._stats.iteritems())
+        for (method, kind, site), (count, errors, seconds, keys, sent, received, buckets) in stats:
+            _log.info('Datastore %s %s from %s: %d calls, %d errors, %.3fs total, %.1fms mean, '
+                    '%d keys, %d bytes sent, %d bytes received.', method, kind, site, count, errors,
+                    seconds, seconds * 1000 / count, keys, sent, received)
+        if _metrics_file and stats:
+            self.write_metrics(_metrics_file, stats)
+
+    def write_metrics(self, path, stats):
+        """ Writes the stats in the Prometheus text format, for the node exporter textfile collector. """
+
+        lines = []
+        def add(name, kind, help, samples):
+            lines.append('# HELP srp_datastore_%s %s' % (name, help))
+            lines.append('# TYPE srp_datastore_%s %s' % (name, kind))
+            for suffix, labels, value in samples:
+                label = ','.join('%s="%s"' % (key, value) for key, value in labels)
+                lines.append('srp_datastore_%s%s{%s} %s' % (name, suffix, label, value))
+        def labels(key):
+            return zip(('method', 'kind', 'site'), key)
+        samples = []
+        for key, stat in stats:
+            total = 0
+            for bound, count in zip(_latency_buckets + ('+Inf',), stat[6]):
+                total += count
+                samples.append(('_bucket', labels(key) + [('le', bound)], total))
+            samples.append(('_sum', labels(key), repr(stat[2])))
+            samples.append(('_count', labels(key), stat[0]))
+        add('rpc_seconds', 'histogram', 'Latency of datastore RPCs.', samples)
+        for index, name, help in ((1, 'rpc_errors_total', 'Datastore RPCs that failed.'),
+                (3, 'rpc_keys_total', 'Keys looked up, written or returned by datastore RPCs.'),
+                (4, 'rpc_sent_bytes_total', 'Bytes of datastore RPC requests.'),
+                (5, 'rpc_received_bytes_total', 'Bytes of datastore RPC responses.')):
+            add(name, 'counter', help, [('', labels(key), stat[index]) for key, stat in stats])
+        temp = path + '.tmp'
+        with open(temp, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.rename(temp, path)
+
+_rpc_stats = _RpcStats()
+atexit.register(_rpc_stats.report)
+
+def _rpc(method, req, site = None):
+    """ Makes a googledatastore call and records it in _rpc_stats. """
+
+    site = site or getattr(_context, 'site', None) or _caller()
+    start = time.time()
+    resp = None
+    try:
+        resp = getattr(googledatastore, method)(req)
+        return resp
+    finally:
+        seconds = time.time() - start
+        _rpc_stats.record(method, _request_kind(method, req), site, seconds,
+                _response_keys(method, req, resp) if resp is not None else 0,
+                req.ByteSize(), resp.ByteSize() if resp is not None else 0, resp is None)
+
+def _lookup(req, site = None):
+    return _rpc('lookup', req, site)
+
+def _commit(req, site = None):
+    return _rpc('commit', req, site)
+
+def _run_query(req, site = None):
+    return _rpc('run_query', req, site)
+
+def _begin_transaction(req, site = None):
+    return _rpc('begin_transaction', req, site)
+
+class _Future(object):
+    """ The pending result of a call made on an _Executor. """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def _run(self, fn, args, site = None):
+        previous = getattr(_context, 'site', None)
+        _context.site = site
+        try:
+            self._result = fn(*args)
+        except:
+            self._error = sys.exc_info()
+        finally:
+            _context.site = previous
+        self._done.set()
+
+    def result(self):
+        """ Waits for the call to finish, then returns its result or raises its exception. """
+
+        self._done.wait()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+        return self._result
+
+class _Executor(object):
+    """ A fixed pool of daemon threads that keeps several datastore RPCs in flight.
+
+    googledatastore keeps a connection per thread, so each worker gets its own connection.
+    With fewer than 1 worker, calls run in the calling thread.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """ Queues a call to fn and returns a _Future for its result. """
+
+        future = _Future()
+        if self.workers < 1:
+            future._run(fn, args, getattr(_context, 'site', None))
+            return future
+        self._start()
+        # The worker records its RPCs against the method that submitted the call.
+        self._queue.put((future, fn, args, getattr(_context, 'site', None) or _caller()))
+        return future
+
+    def imap(self, fn, items):
+        """ Calls fn on each item with up to workers calls in flight, yielding results in order.
+
+        If a call fails, its exception is raised when its result is reached.
+        """
+
+        pending = deque()
+        index = 0
+        for item in items:
+            pending.append((index, self.submit(fn, item)))
+            index += 1
+            if len(pending) > self.workers:
+                yield self.__result(*pending.popleft())
+        while pending:
+            yield self.__result(*pending.popleft())
+
+    def __result(self, index, future):
+        try:
+            return future.result()
+        except:
+            _log.error('Datastore batch %d failed.', index)
+            raise
+
+    def _start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target = self._work,
+                        name = 'datastore-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def shutdown(self, timeout = 5.0):
+        """ Lets the running calls finish and stops the worker threads.
+
+        Waits at most timeout seconds in all, so a call stuck on the network cannot hold up exit. The
+        workers are daemon threads, so any still running are dropped.
+        """
+
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for thread in threads:
+            self._queue.put(None)
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+        running = [thread.name for thread in threads if thread.is_alive()]
+        if running:
+            _log.warning('Datastore workers %s still running after %.0fs, exiting anyway.',
+                    ', '.join(running), timeout)
+
+    def _work(self):
+        while True:
+            work = self._queue.get()
+            if work is None:
+                break
+            future, fn, args, site = work
+            future._run(fn, args, site)
 
-def _date_to_timestamp(date):
-    return long(calendar.timegm(date.utctimetuple()) * 1000000L) + date.microsecond
+_executor = _Executor(_int_option('rpc_concurrency', 4))
+atexit.register(_executor.shutdown)
+
+class _EntityCache(object):
+    """ Least recently used cache of stored entities keyed by kind and id.
+
+    Holds the entity protobufs rather than model objects, so every load gets its own copy to change.
+    None is cached for entities that are known not to exist. Entries expire after ttl seconds, so
+    changes made by other processes are picked up.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # [hits, misses] for each kind.
+        self._stats = dict()
+
+    def get(self, kind, id):
+        """ Returns a (hit, entity) pair, where entity is None if it is known not to exist. """
+
+        key = (kind, id)
+        with self._lock:
+            stats = self._stats.setdefault(kind, [0, 0])
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                stats[1] += 1
+                return False, None
+            self._entries[key] = entry
+            stats[0] += 1
+            return True, entry[1]
+
+    def put(self, kind, id, entity):
+        key = (kind, id)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, entity)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def log_stats(self):
+        for kind, (hits, misses) in sorted(self._stats.iteritems()):
+            _log.info('Entity cache for %s: %d hits, %d misses.', kind, hits, misses)
+
+_cache = _EntityCache(_int_option('cache_size', 10000), _int_option('cache_ttl', 300))
+atexit.register(_cache.log_stats)
+
+def _batches(items, max_count, max_bytes = None, size = None):
+    """ Splits items into lists of at most max_count items and, when size is given, max_bytes bytes.
+
+    An item that is bigger than max_bytes on its own is put in a batch by itself.
+    """
+
+    batch = []
+    batch_bytes = 0
+    for item in items:
+        item_bytes = size(item) if size else 0
+        if batch and (len(batch) >= max_count or (size and batch_bytes + item_bytes > max_bytes)):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append(item)
+        batch_bytes += item_bytes
+    if batch:
+        yield batch
 
 class _BaseEntity(object):
     """ Base class for all entities.
 
     Handles the conversion between the simple model objects defined in this module and google
     cloud datastore entity objects.
+    Attributes starting with an underscore are bookkeeping and are never stored.
+    Sub-classes declare their stored fields and types in _fields, see _Codec. They may also declare
+    __slots__ instead of using an instance dictionary, in which case the slots are the stored fields.
     """
 
+    __slots__ = ()
+
+    # Digest of each field as it was last loaded from or saved to the datastore.
+    _snapshot = None
+    # Sub entity fields written as a single compressed blob when the pack_sub_entities option is set.
+    _packed = ()
+
     def _sub_entities(self):
         """ Get a dictionary of sub entities of the current entity.
 
         The keys of the dictionary are the field names in the current entity.
-        The values are the model class used by that field.
-        By default this is an empty dictionary unless overridden in a subclass.
+        The values are the model class used by that field, as declared in _fields.
         """
 
-        return dict()
+        return _codec(type(self)).sub_entities
 
-    def _get_entity(self):
-        """ Get the cloud datastore representation of this entity. """
+    def _field_items(self):
+        """ Get the name and value of each stored field. """
+
+        try:
+            attrs = self.__dict__
+        except AttributeError:
+            return [(name, getattr(self, name, None)) for name in self.__slots__]
+        return [(key, val) for key, val in attrs.iteritems() if not key.startswith('_')]
+
+    def _get_entity(self, skip = ()):
+        """ Get the cloud datastore representation of this entity, leaving out the fields in skip. """
 
         _log.debug('%s._get_entity()', type(self).__name__)
-        self.__fix_strings()
         entity = googledatastore.Entity()
-        attrs = self.__dict__
-        simple_attrs = dict()
-        complex_attrs = dict()
-        def process_entity(e):
-            if isinstance(e, _BaseEntity):
-                return e._get_entity()
-            elif isinstance(e, list):
-                return [process_entity(s) for s in e if s is not None]
-            else:
-                return e
-        for key, val in attrs.iteritems():
-            if isinstance(val, _BaseEntity):
-                complex_attrs[key] = val._get_entity()
-            elif isinstance(val, list):
-                complex_attrs[key] = [process_entity(e) for e in val if e is not None]
-            elif val is not None:
-                simple_attrs[key] = val
-        add_properties(entity, simple_attrs, indexed = True)
-        add_properties(entity, complex_attrs, indexed = False)
+        _codec(type(self)).encode(self, entity, skip)
         return entity
 
     def _set_entity(self, entity):
         """ Update this entity with values from the cloud datastore representation. """
 
         _log.debug('%s._set_entity()', type(self).__name__)
-        attrs = get_property_dict(entity)
-        def process_entity(entity, cls):
-            if isinstance(entity, list):
-                return [process_entity(e, cls) for e in entity]
-            else:
-                e = cls()
-                e._set_entity(entity)
-                return e
-        attrs = { key: get_value(val) for (key, val) in attrs.iteritems() }
-        for name, cls in self._sub_entities().iteritems():
-            if name in attrs and attrs[name]:
-                attrs[name] = process_entity(attrs[name], cls)
-        for key, val in attrs.iteritems():
-            setattr(self, key, val)
-
-    def __fix_strings(self):
-        for key in self.__dict__.keys():
-            val = getattr(self, key)
-            if type(val) is str:
-                setattr(self, key, unicode(val))
+        _codec(type(self)).decode(self, entity)
+
+    def _field_digests(self):
+        """ Get a digest of each stored field, keyed by field name. """
+
+        return { key: _digest(val) for key, val in self._field_items()
+                if key not in _timestamp_fields
+                and val is not None and val != [] }
+
+    def _take_snapshot(self):
+        """ Remember the current state as the state held by the datastore. """
+
+        self._snapshot = self._field_digests()
+
+    def dirty_fields(self):
+        """ Get the names of the fields that changed since the entity was loaded or saved.
+
+        Returns None if the entity was never loaded or saved, as all of its fields need writing.
+        """
+
+        if self._snapshot is None:
+            return None
+        current = self._field_digests()
+        names = set(current.keys()).union(self._snapshot.keys())
+        return sorted(name for name in names if current.get(name) != self._snapshot.get(name))
+
+    def is_dirty(self):
+        """ Check whether the entity has changes that have not been written to the datastore. """
+
+        return self._snapshot is None or len(self.dirty_fields()) > 0
 
 class RootEntity(_BaseEntity):
     """ Base class for entities that will be stored in cloud datastore as their own kind. """
 
+    # Number of keys per lookup for this kind, defaults to the lookup_batch_keys option.
+    _lookup_batch_keys = None
+    # Set on entities loaded by a projection query, which only hold some of their fields.
+    _partial = False
+    # Whether loads of this kind read through the entity cache, for small entities that are loaded
+    # over and over within a job.
+    _cached = False
+    # Stored values of sub entity fields that have not been decoded yet, keyed by field name.
+    _lazy = None
+
+    # Set by save().
+    _fields = (
+        ('created_time', datetime),
+        ('modified_time', datetime)
+    )
+
     def _get_entity(self):
-        """ Override base class implementation to also set the key value. """
+        """ Override base class implementation to also set the key value.
 
-        entity = _BaseEntity._get_entity(self)
-        entity.key.CopyFrom(self.__get_key())
+        Sub entity fields that were never accessed are written back as they were loaded. The key is made
+        first, as _get_id() also brings derived fields such as KillMail.outstanding_amount up to date.
+        """
+
+        key = self.__get_key()
+        undecoded = self.__undecoded()
+        entity = _BaseEntity._get_entity(self, dict(undecoded))
+        entity.key.CopyFrom(key)
+        for name, value in undecoded:
+            prop = entity.property.add()
+            prop.name = name
+            prop.value.CopyFrom(value)
         return entity
 
+    def _set_entity(self, entity):
+        """ Override base class implementation to remember the loaded state.
+
+        Sub entity fields are kept as stored values and only decoded when they are first accessed.
+        """
+
+        _log.debug('%s._set_entity()', type(self).__name__)
+        codec = _codec(type(self))
+        lazy = dict()
+        for prop in entity.property:
+            if prop.name in codec.sub_entities:
+                lazy[prop.name] = prop.value
+                self.__dict__.pop(prop.name, None)
+            else:
+                codec.decode_property(self, prop)
+        self._lazy = lazy
+        self._take_snapshot()
+
+    def __getattr__(self, name):
+        # Only called when normal attribute lookup fails, so decoded fields never get here.
+        lazy = self._lazy
+        if not lazy or name not in lazy:
+            raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
+        val = _codec(type(self)).decoders[name](lazy.pop(name))
+        self.__dict__[name] = val
+        if self._snapshot is not None:
+            self._snapshot.pop(name, None)
+            if val is not None and val != []:
+                self._snapshot[name] = _digest(val)
+        return val
+
+    def __undecoded(self):
+        if not self._lazy:
+            return []
+        return [(name, value) for name, value in self._lazy.iteritems() if name not in self.__dict__]
+
+    def _field_digests(self):
+        """ Override base class implementation to include the fields that are still undecoded. """
+
+        digests = _BaseEntity._field_digests(self)
+        for name, value in self.__undecoded():
+            digests[name] = _UNDECODED
+        return digests
+
     def _get_id(self):
         """ Should be overridden by all sub-classes to get the entities id. """
         pass
@@ -99,36 +876,114 @@ class RootEntity(_BaseEntity):
     def load(self):
         """ Loads an entity from the datastore. """
 
-        _log.debug('Loading %s entity with id %s.', type(self).__name__, self._get_id())
+        kind = type(self).__name__
+        id = self._get_id()
+        _log.debug('Loading %s entity with id %s.', kind, id)
+        if self._cached:
+            hit, entity = _cache.get(kind, id)
+            if hit:
+                if entity is None:
+                    return False
+                self._set_entity(entity)
+                return True
         resp = self.__lookup()
-        if resp.found:
-            self._set_entity(resp.found[0].entity)
-            return True
-        return False
+        entity = resp.found[0].entity if resp.found else None
+        if self._cached:
+            _cache.put(kind, id, entity)
+        if entity is None:
+            return False
+        self._set_entity(entity)
+        return True
+
+    def _saved(self, proto):
+        """ Records that the entity was written as proto. """
+
+        self._take_snapshot()
+        if self._cached:
+            _cache.put(type(self).__name__, self._get_id(), proto)
 
     def save(self):
-        """ Saves an entity to the datastore. """
+        """ Saves an entity to the datastore.
 
+        Does nothing if none of the fields changed since the entity was loaded or last saved.
+        """
+
+        self._check_writable()
+        if not self.is_dirty():
+            _log.debug('Skipping save of unchanged %s entity with id %s.', type(self).__name__, self._get_id())
+            return
+        session = Session.current()
+        if session is not None:
+            session.save(self)
+            return
         _log.debug('Saving %s entity with id %s.', type(self).__name__, self._get_id())
-        req = googledatastore.BeginTransactionRequest()
-        resp = googledatastore.begin_transaction(req)
-        tx = resp.transaction
-        self.modified_time = datetime.utcnow()
-        resp = self.__lookup(tx)
-        if not resp.found:
-            self.created_time = self.modified_time
-        self.__upsert(tx)
+        RootEntity._write([self])
+
+    def _transact(self, change):
+        """ Reloads the entity in a transaction, calls change(self) and writes the entity back.
+
+        Returns what change returned. See RootEntity.transact.
+        """
+
+        return RootEntity.transact([self], change)
+
+    @staticmethod
+    def transact(entities, change, also = ()):
+        """ Reloads entities in a transaction, calls change(*entities) and writes them back, along with
+        the entities in also, in the same commit.
+
+        The entities are read from the datastore, never from the entity cache, so change sees what is
+        stored. Entities that are not stored yet keep the values they were given. change works on
+        copies, so when another writer commits one of the entities first the transaction is tried
+        again from the stored values. The write does not wait for an open session. Returns what
+        change returned.
+        """
+
+        for entity in list(entities) + list(also):
+            entity._check_writable()
+        for attempt in range(_transaction_attempts):
+            transaction = _begin_transaction(googledatastore.BeginTransactionRequest()).transaction
+            working = [copy.deepcopy(entity) for entity in entities]
+            req = googledatastore.LookupRequest()
+            req.key.extend([entity.__get_key() for entity in working])
+            req.read_options.transaction = transaction
+            found = dict(((result.entity.key.path_element[-1].kind, _key_id(result.entity.key)), result.entity)
+                    for result in _lookup(req).found)
+            for entity in working:
+                stored = found.get((type(entity).__name__, entity._get_id()))
+                if stored is not None:
+                    entity._set_entity(stored)
+            result = change(*working)
+            time = datetime.utcnow()
+            for entity in working + list(also):
+                entity.modified_time = time
+                if getattr(entity, 'created_time', None) is None:
+                    entity.created_time = time
+            req = googledatastore.CommitRequest()
+            req.transaction = transaction
+            protos = [entity._get_entity() for entity in working + list(also)]
+            req.mutation.upsert.extend(protos)
+            try:
+                _commit(req)
+            except googledatastore.RPCError as e:
+                if e.response.status != 409 or attempt == _transaction_attempts - 1:
+                    raise
+                _log.warning('Transaction on %s collided, trying again.',
+                        ', '.join('%s %s' % (type(entity).__name__, entity._get_id()) for entity in working))
+                continue
+            for entity, done in zip(entities, working):
+                entity.__dict__ = done.__dict__
+            for entity, proto in zip(list(entities) + list(also), protos):
+                entity._saved(proto)
+            return result
+
+    def _check_writable(self):
+        if self._partial:
+            raise ValueError('%s entity with id %s was loaded by a projection query and cannot be saved.' %
+                    (type(self).__name__, self._get_id()))
 
     def __get_key(self):
-        key = googledatastore.Key()
-        path = key.path_element.add()
-        path.kind = type(self).__name__
-        id = self._get_id()
-        if isinstance(id, basestring):
-            path.name = id
-        else:
-            path.id = id
-        return key
+        return _make_key(type(self).__name__, self._get_id())
 
     def __lookup(self, transaction = None):
         _log.debug('%s.__lookup()', type(self).__name__)
@@ -136,177 +991,558 @@ class RootEntity(_BaseEntity):
         req.key.extend([self.__get_key()])
         if transaction:
             req.read_options.transaction = transaction
-        return googledatastore.lookup(req)
+        return _lookup(req)
+
+    @staticmethod
+    def _write(entities, batch_size = None):
+        """ Writes entities using the configured save protocol.
+
+        Entities are packed into batches by count and by encoded size, so that small entities share
+        a commit and a huge one gets a commit to itself.
+        """
+
+        time = datetime.utcnow()
+        if _save_protocol == 'transactional':
+            max_count = min(batch_size or _transaction_batch_keys, _transaction_batch_keys)
+            batches = _batches(entities, max_count)
+            for _ in _executor.imap(lambda batch: RootEntity._save_batch_transactional(batch, time), batches):
+                pass
+            return
+        def encode(entity):
+            entity.modified_time = time
+            if entity._snapshot is None and getattr(entity, 'created_time', None) is None:
+                entity.created_time = time
+            return entity, entity._get_entity()
+        encoded = (encode(entity) for entity in entities)
+        batches = _batches(encoded, batch_size or _commit_batch_mutations, _commit_batch_bytes,
+                lambda (entity, proto): proto.ByteSize())
+        # Later batches are encoded while the earlier ones are being committed.
+        for _ in _executor.imap(lambda batch: RootEntity._commit_batch(batch, time), batches):
+            pass
+
+    @staticmethod
+    def _commit_batch(batch, time):
+        """ Writes a batch of (entity, encoded entity) pairs in one commit.
+
+        Entities that were loaded from the datastore are updated and all others are inserted, so the
+        created time can be set without looking the entities up first. If the commit is rejected,
+        because an entity that was never loaded already exists or a loaded entity has since been
+        deleted, the batch is written again with the transactional protocol.
+        """
 
-    def __upsert(self, transaction = None):
-        _log.debug('%s.__upsert()', type(self).__name__)
         req = googledatastore.CommitRequest()
-        if transaction:
-            req.transaction = transaction
-        else:
-            req.mode = googledatastore.CommitRequest.NON_TRANSACTIONAL
-        entity = self._get_entity()
-        req.mutation.upsert.extend([entity])
-        googledatastore.commit(req)
+        req.mode = googledatastore.CommitRequest.NON_TRANSACTIONAL
+        for entity, proto in batch:
+            if entity._snapshot is None:
+                req.mutation.insert.extend([proto])
+            else:
+                req.mutation.update.extend([proto])
+        try:
+            _commit(req)
+        except googledatastore.RPCError as e:
+            if e.response.status >= 500:
+                raise
+            _log.warning('Insert / update of %d entities failed, retrying in a transaction: %s',
+                    len(batch), e)
+            entities = [entity for entity, proto in batch]
+            for retry in _batches(entities, _transaction_batch_keys):
+                RootEntity._save_batch_transactional(retry, time)
+            return
+        for entity, proto in batch:
+            entity._saved(proto)
+
+    @staticmethod
+    def _save_batch_transactional(entities, time):
+        """ Writes a batch of entities in a transaction, looking them up first to set created times. """
+
+        req = googledatastore.BeginTransactionRequest()
+        resp = _begin_transaction(req)
+        transaction = resp.transaction
+        # Bulk lookup
+        req = googledatastore.LookupRequest()
+        req.key.extend([entity.__get_key() for entity in entities])
+        req.read_options.transaction = transaction
+        resp = _lookup(req)
+        # Update created / modified times, keeping the stored created time of existing entities.
+        found = dict()
+        for result in resp.found:
+            key = result.entity.key.path_element[0]
+            found[(key.kind, key.id or key.name)] = get_property_dict(result.entity).get('created_time')
+        for entity in entities:
+            entity.modified_time = time
+            key = (type(entity).__name__, entity._get_id())
+            if key not in found:
+                entity.created_time = time
+            elif found[key] is not None:
+                entity.created_time = get_value(found[key])
+        # Bulk upsert
+        req = googledatastore.CommitRequest()
+        req.transaction = transaction
+        protos = [entity._get_entity() for entity in entities]
+        req.mutation.upsert.extend(protos)
+        _commit(req)
+        for entity, proto in zip(entities, protos):
+            entity._saved(proto)
 
     @classmethod
     def load_multi(cls, ids):
         """ Loads multiple entities from the datastore in batches. """
 
         _log.debug('Looking up %s entities with ids: %s.' % (cls.__name__, ids))
-        def get_key(id):
-            key = googledatastore.Key()
-            path = key.path_element.add()
-            path.kind = cls.__name__
-            if isinstance(id, basestring):
-                path.name = id
-            else:
-                path.id = id
-            return key
-        def get_entity(result):
+        kind = cls.__name__
+        def get_entity(proto):
             entity = cls()
-            entity._set_entity(result.entity)
+            entity._set_entity(proto)
             return entity
-        l = []
-        for id in ids:
-            l.append(id)
-            if len(l) >= 10:
-                _log.debug('Fetching %s' % l)
+        if cls._cached:
+            missed = []
+            for id in ids:
+                hit, proto = _cache.get(kind, id)
+                if not hit:
+                    missed.append(id)
+                elif proto is not None:
+                    yield get_entity(proto)
+            ids = missed
+        def lookup_batch(batch):
+            found = []
+            while batch:
+                _log.debug('Fetching %d %s entities.', len(batch), cls.__name__)
                 req = googledatastore.LookupRequest()
-                req.key.extend(map(get_key, l))
-                resp = googledatastore.lookup(req)
-                for res in resp.found:
-                    yield get_entity(res)
-                l = []
-        if len(l) > 0:
-            _log.debug('Fetching %s' % l)
-            req = googledatastore.LookupRequest()
-            req.key.extend(map(get_key, l))
-            resp = googledatastore.lookup(req)
-            for res in resp.found:
-                yield get_entity(res)
+                req.key.extend(batch)
+                resp = _lookup(req)
+                found.extend(resp.found)
+                # Keys that did not fit in the response are deferred and need asking for again.
+                batch = list(resp.deferred)
+            return found
+        keys = (_make_key(kind, id) for id in ids)
+        batches = _batches(keys, cls._lookup_batch_keys or _lookup_batch_keys)
+        found_ids = set()
+        for found in _executor.imap(lookup_batch, batches):
+            for res in found:
+                if cls._cached:
+                    id = _key_id(res.entity.key)
+                    found_ids.add(id)
+                    _cache.put(kind, id, res.entity)
+                yield get_entity(res.entity)
+        if cls._cached:
+            # Remember the ids that do not exist too.
+            for id in ids:
+                if id not in found_ids:
+                    _cache.put(kind, id, None)
+
+    @classmethod
+    def exists_multi(cls, ids):
+        """ Finds which of the given ids are stored, without loading the entities.
+
+        Integer ids are checked with keys-only queries over ranges of nearby ids, any other ids are
+        looked up. Returns the set of ids that exist.
+        """
+
+        ids = set(ids)
+        _log.debug('Checking which of %d %s entities exist.', len(ids), cls.__name__)
+        int_ids = sorted(id for id in ids if isinstance(id, (int, long)))
+        found = set()
+        for first, last in _id_ranges(int_ids, _exists_range_gap):
+            query = (cls.select()
+                    .filter('__key__', '>=', _make_key(cls.__name__, first))
+                    .filter('__key__', '<=', _make_key(cls.__name__, last))
+                    .page_size(_lookup_batch_keys))
+            found.update(id for id in query.ids() if id in ids)
+        other_ids = ids.difference(int_ids)
+        if other_ids:
+            found.update(entity._get_id() for entity in cls.load_multi(other_ids))
+        return found
 
     @staticmethod
-    def bulk_save(entities):
-        """ Saves multiple entities to the datastore in batches. """
+    def dirty(entities):
+        """ Get the entities that have changes that have not been written to the datastore. """
 
-        batch_size = 5
-        time = datetime.utcnow()
-        def save_batch(entities):
-            req = googledatastore.BeginTransactionRequest()
-            resp = googledatastore.begin_transaction(req)
-            transaction = resp.transaction
-            # Bulk lookup
-            req = googledatastore.LookupRequest()
-            req.key.extend([entity.__get_key() for entity in entities])
-            req.read_options.transaction = transaction
-            resp = googledatastore.lookup(req)
-            # Update created / modified times.
-            missing = set()
-            for result in resp.missing:
-                key = result.entity.key.path_element[0]
-                missing.add(key.id or key.name)
-            for entity in entities:
-                entity.modified_time = time
-                if entity._get_id() in missing:
-                    entity.created_time = time
-            # Bulk upsert
-            req = googledatastore.CommitRequest()
-            req.transaction = transaction
-            req.mutation.upsert.extend([entity._get_entity() for entity in entities])
-            googledatastore.commit(req)
-        for chunk in range(0, len(entities), batch_size):
-            save_batch(entities[chunk:chunk+batch_size])
+        return [entity for entity in entities if entity.is_dirty()]
+
+    @staticmethod
+    def bulk_save(entities, batch_size = None):
+        """ Saves multiple entities to the datastore in batches.
+
+        Entities of different kinds may be mixed in the same call.
+        Entities without changes since they were loaded or last saved are skipped.
+        Batches are limited by the commit_batch_mutations and commit_batch_bytes options, or by
+        batch_size entities if that is given.
+        """
+
+        for entity in entities:
+            entity._check_writable()
+        count = len(entities)
+        entities = RootEntity.dirty(entities)
+        _log.debug('Saving %d of %d entities, the rest are unchanged.', len(entities), count)
+        RootEntity._write(entities, batch_size)
 
     @staticmethod
     def bulk_delete(entities):
-        batch_size = 5
         def delete_batch(batch):
             req = googledatastore.CommitRequest()
             req.mode = googledatastore.CommitRequest.NON_TRANSACTIONAL
             req.mutation.delete.extend([entity.__get_key() for entity in batch])
-            googledatastore.commit(req)
-        for chunk in range(0, len(entities), batch_size):
-            delete_batch(entities[chunk:chunk+batch_size])
+            _commit(req)
+            for entity in batch:
+                if entity._cached:
+                    _cache.put(type(entity).__name__, entity._get_id(), None)
+        for _ in _executor.imap(delete_batch, _batches(entities, _commit_batch_mutations)):
+            pass
 
     @classmethod
     def query(cls, req):
+        """ Runs a GQL query that has a 'LIMIT n OFFSET @startCursor' clause, one page at a time. """
+
         _log.debug('%s.query(%s)', cls.__name__, req.gql_query.query_string)
 
         cursor_arg = req.gql_query.name_arg.add()
         cursor_arg.name = 'startCursor'
-
-        cursor = None
-        while True:
-            if cursor is None:
-                cursor_arg.value.integer_value = 0
-            else:
-                cursor_arg.ClearField('value')
-                cursor_arg.cursor = cursor
-
-            resp = googledatastore.run_query(req)
-            for result in resp.batch.entity_result:
+        cursor_arg.value.integer_value = 0
+        for batch in _run_pages(req):
+            for result in batch.entity_result:
                 entity = cls()
                 entity._set_entity(result.entity)
                 yield entity
-            if resp.batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS:
-                break
-            if len(resp.batch.entity_result) == 0:
-                break
-            cursor = resp.batch.end_cursor
+
+    @classmethod
+    def select(cls):
+        """ Starts building a query for entities of this type. """
+
+        return Query(cls)
 
     @classmethod
     def all(cls):
         """ Loads all entities of this type from the datastore. """
 
         _log.debug('%s.all()', cls.__name__)
+        return cls.select()
+
+    @classmethod
+    def wipeout(cls):
+        """ Deletes all entities of this type from the datastore. """
+
+        _log.debug('%s.wipeout()', cls.__name__)
+        _cache.clear()
+        def delete_keys(keys):
+            req = googledatastore.CommitRequest()
+            req.mode = googledatastore.CommitRequest.NON_TRANSACTIONAL
+            req.mutation.delete.extend(keys)
+            _commit(req)
+        deletes = deque()
+        for batch in cls.select().keys_only().page_size(_commit_batch_mutations).pages():
+            # Delete this page while the next one is being fetched.
+            keys = [result.entity.key for result in batch.entity_result]
+            deletes.append(_executor.submit(delete_keys, keys))
+            if len(deletes) > _executor.workers:
+                deletes.popleft().result()
+        while deletes:
+            deletes.popleft().result()
+
+def _run_page(req, cursor, site = None):
+    page = googledatastore.RunQueryRequest()
+    page.CopyFrom(req)
+    if cursor is not None:
+        for arg in page.gql_query.name_arg:
+            if arg.name == 'startCursor':
+                arg.ClearField('value')
+                arg.cursor = cursor
+    return _run_query(page, site).batch
+
+def _run_pages(req, future = None, site = None):
+    """ Runs a GQL query with a startCursor argument, yielding each batch of results.
+
+    The next page is fetched in the background while the caller works through the current one.
+    A future for the first page can be passed in when it has already been submitted.
+    """
+
+    if future is None:
+        future = _executor.submit(_run_page, req, None, site)
+    while True:
+        batch = future.result()
+        more = (batch.more_results != googledatastore.QueryResultBatch.NO_MORE_RESULTS
+                and len(batch.entity_result) > 0)
+        if more:
+            future = _executor.submit(_run_page, req, batch.end_cursor, site)
+        yield batch
+        if not more:
+            break
+
+class _Descending(object):
+    """ Wraps a sort value so that it orders in reverse. """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+def _sort_key(orders, entity):
+    values = []
+    for name in orders:
+        descending = name.startswith('-')
+        if descending:
+            name = name[1:]
+        if name == '__key__':
+            value = _key_id(entity.key)
+        else:
+            value = None
+            for prop in entity.property:
+                if prop.name == name:
+                    value = get_value(prop.value)
+                    break
+        values.append(_Descending(value) if descending else value)
+    return tuple(values)
+
+def _merge_results(orders, streams):
+    """ Merges streams of entity results that are each sorted by orders into one sorted stream. """
+
+    def keyed(index, stream):
+        for seq, result in enumerate(stream):
+            yield _sort_key(orders, result.entity), index, seq, result
+    merged = heapq.merge(*[keyed(index, stream) for index, stream in enumerate(streams)])
+    for key, index, seq, result in merged:
+        yield result
+
+def _set_arg(arg, name, value):
+    arg.name = name
+    if type(value) is str:
+        value = unicode(value)
+    elif type(value) is long:
+        value = int(value)
+    set_value(arg.value, value)
+
+class Query(object):
+    """ Builds and runs a GQL query for a RootEntity kind.
+
+        Query(KillMail).filter('loss_mail', '=', True).order('kill_time', '-kill_id').page_size(100)
+
+    Iterating over a query yields the matching entities. Results are fetched a page at a time and
+    the next page is fetched in the background while the current one is being used.
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        self._filters = []
+        self._orders = []
+        self._page_size = _query_page_size
+        self._keys_only = False
+        self._projection = None
+        self._fan_out = None
+        self._cursor = None
+        self._site = _caller()
+
+    def filter(self, name, op, value):
+        """ Adds a condition, op is one of =, <, <=, > or >=. """
+
+        self._filters.append((name, op, value))
+        return self
+
+    def filter_in(self, name, values):
+        """ Adds a condition that name equals any of the values.
+
+        The datastore has no IN operator, so one query is run per value. The queries run
+        concurrently, each paged with its own cursor, and their results are merged by the sort
+        orders of this query, so the orders need to be given for the results to come back sorted.
+        """
+
+        self._fan_out = (name, list(values))
+        return self
+
+    def order(self, *names):
+        """ Adds sort orders, a name starting with - sorts in descending order. """
+
+        self._orders.extend(names)
+        return self
 
+    def page_size(self, size):
+        """ Sets the number of results fetched per request. """
+
+        self._page_size = size
+        return self
+
+    def start(self, cursor):
+        """ Starts the query at a cursor, the end_cursor of a batch returned by pages(). """
+
+        self._cursor = cursor
+        return self
+
+    def keys_only(self):
+        """ Only fetch the keys of the matching entities. """
+
+        self._keys_only = True
+        return self
+
+    def project(self, *names):
+        """ Only fetch the named properties, which need to be indexed.
+
+        Entities are only returned if they have all of the named properties, and a list property
+        returns one entity per value. The entities returned cannot be saved.
+        """
+
+        self._projection = names
+        return self
+
+    def _request(self, filters = None):
+        if filters is None:
+            filters = self._filters
         req = googledatastore.RunQueryRequest()
         query = req.gql_query
-        query.query_string = 'SELECT * FROM %s LIMIT 50 OFFSET @startCursor ' % cls.__name__
         query.allow_literal = True
+        if self._keys_only:
+            selection = '__key__'
+        elif self._projection:
+            selection = ', '.join(self._projection)
+        else:
+            selection = '*'
+        parts = ['SELECT %s FROM %s' % (selection, self.cls.__name__)]
+        conditions = []
+        for index, (name, op, value) in enumerate(filters):
+            arg_name = 'arg%d' % index
+            conditions.append('%s %s @%s' % (name, op, arg_name))
+            _set_arg(query.name_arg.add(), arg_name, value)
+        if conditions:
+            parts.append('WHERE ' + ' AND '.join(conditions))
+        if self._orders:
+            parts.append('ORDER BY ' + ', '.join(
+                    name[1:] + ' DESC' if name.startswith('-') else name for name in self._orders))
+        parts.append('LIMIT %d OFFSET @startCursor' % self._page_size)
+        _set_arg(query.name_arg.add(), 'startCursor', 0)
+        query.query_string = ' '.join(parts)
+        return req
+
+    def pages(self):
+        """ Runs the query, yielding each raw batch of results. """
+
+        if self._fan_out is not None:
+            raise ValueError('Query with filter_in has no single page sequence, iterate it instead.')
+        req = self._request()
+        _log.debug('%s.query(%s)', self.cls.__name__, req.gql_query.query_string)
+        if self._cursor is not None:
+            return _run_pages(req, _executor.submit(_run_page, req, self._cursor, self._site), self._site)
+        return _run_pages(req, site = self._site)
+
+    def _results(self):
+        if self._fan_out is None:
+            for batch in self.pages():
+                for result in batch.entity_result:
+                    yield result
+            return
+        name, values = self._fan_out
+        reqs = [self._request(self._filters + [(name, '=', value)]) for value in values]
+        if reqs:
+            _log.debug('%s.query(%s) for %d values of %s', self.cls.__name__,
+                    reqs[0].gql_query.query_string, len(reqs), name)
+        # Submit every first page before waiting on any of them.
+        firsts = [_executor.submit(_run_page, req, None, self._site) for req in reqs]
+        streams = [(result for batch in _run_pages(req, first, self._site) for result in batch.entity_result)
+                for req, first in zip(reqs, firsts)]
+        for result in _merge_results(self._orders, streams):
+            yield result
+
+    def ids(self):
+        """ Runs the query as a keys-only query, yielding the id of each matching entity. """
+
+        if self._fan_out is not None and [name for name in self._orders if name.lstrip('-') != '__key__']:
+            raise ValueError('Keys-only queries with filter_in can only be ordered by __key__.')
+        self._keys_only = True
+        for result in self._results():
+            yield _key_id(result.entity.key)
+
+    def __iter__(self):
+        for result in self._results():
+            entity = self.cls()
+            entity._set_entity(result.entity)
+            if self._projection:
+                entity._partial = True
+            yield entity
 
-        return cls.query(req)
+_sessions = []
 
-    @classmethod
-    def wipeout(cls):
-        """ Deletes all entities of this type from the datastore. """
+class Session(object):
+    """ Unit of work for batch jobs.
 
-        _log.debug('%s.wipeout()', cls.__name__)
-        batch_size = 500
-        cursor = None
-        while True:
-            req = googledatastore.RunQueryRequest()
-            query = req.gql_query
-            query.query_string = 'SELECT __key__ FROM %s LIMIT %d OFFSET @startCursor ' % (
-                    cls.__name__, batch_size)
-            query.allow_literal = True
-
-            cursor_arg = query.name_arg.add()
-            cursor_arg.name = 'startCursor'
-            if cursor is None:
-                cursor_arg.value.integer_value = 0
-            else:
-                cursor_arg.cursor = cursor
+    While a session is open, RootEntity.save() queues the entity on the session instead of writing
+    it straight away. Repeated saves of the same key are coalesced, so only the latest state of each
+    entity is written. Queued entities are written with RootEntity.bulk_save() whenever the queue
+    reaches flush_size, when flush() is called, and when the session is closed.
+    Each flush is packed into as few commits as the batch budgets allow.
 
-            resp = googledatastore.run_query(req)
+        with Session():
+            for kill in kills:
+                kill.save()
+    """
 
-            req = googledatastore.CommitRequest()
-            req.mode = googledatastore.CommitRequest.NON_TRANSACTIONAL
-            req.mutation.delete.extend([result.entity.key for result in resp.batch.entity_result])
-            googledatastore.commit(req)
-            if resp.batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS:
-                break
-            if len(resp.batch.entity_result) == 0:
-                break
-            cursor = resp.batch.end_cursor
+    def __init__(self, flush_size = None, batch_size = None):
+        self.flush_size = flush_size or _int_option('session_flush_size', 500)
+        self.batch_size = batch_size
+        self._pending = OrderedDict()
+
+    def __enter__(self):
+        _sessions.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _sessions.remove(self)
+        # Flush even when the job failed, so that work done before the error is kept just as it
+        # was when every save was written immediately.
+        self.flush()
+        return False
+
+    @staticmethod
+    def current():
+        """ Get the innermost open session, or None if there isn't one. """
+
+        return _sessions[-1] if _sessions else None
+
+    def save(self, entity):
+        """ Queue an entity to be saved at the next flush. """
+
+        key = (type(entity).__name__, entity._get_id())
+        _log.debug('Queueing %s entity with id %s.', key[0], key[1])
+        self._pending[key] = entity
+        if len(self._pending) >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        """ Write all queued entities to the datastore. """
+
+        if not self._pending:
+            return
+        entities = self._pending.values()
+        self._pending = OrderedDict()
+        _log.info('Flushing %d entities.', len(entities))
+        RootEntity.bulk_save(entities, self.batch_size)
 
 class SubEntity(_BaseEntity):
     """ Base class for entities that are only stored as part of another entity. """
-    pass
+
+    __slots__ = ()
 
 class Victim(SubEntity):
 
+    _fields = (
+        ('character_id', int),
+        ('character_name', unicode),
+        ('corporation_id', int),
+        ('corporation_name', unicode),
+        ('alliance_id', int),
+        ('alliance_name', unicode),
+        ('faction_id', int),
+        ('faction_name', unicode),
+        ('damage_taken', int),
+        ('ship_type_id', int),
+        ('ship_name', unicode),
+        ('ship_class', unicode)
+    )
+
     def __init__(self):
         self.character_id = None
         self.character_name = None
@@ -329,6 +1565,27 @@ class Victim(SubEntity):
 
 class Attacker(SubEntity):
 
+    _fields = (
+        ('character_id', int),
+        ('character_name', unicode),
+        ('corporation_id', int),
+        ('corporation_name', unicode),
+        ('alliance_id', int),
+        ('alliance_name', unicode),
+        ('faction_id', int),
+        ('faction_name', unicode),
+        ('damage_done', int),
+        ('final_blow', bool),
+        ('security_status', float),
+        ('ship_type_id', int),
+        ('ship_name', unicode),
+        ('weapon_type_id', int),
+        ('weapon_name', unicode)
+    )
+
+    # Killmails from big fights hold hundreds of attackers, so avoid a dictionary per attacker.
+    __slots__ = tuple(name for name, kind in _fields)
+
     def __init__(self):
         self.character_id = None
         self.character_name = None
@@ -357,6 +1614,21 @@ class Attacker(SubEntity):
 
 class Item(SubEntity):
 
+    _fields = (
+        ('type_id', int),
+        ('flag_id', int),
+        ('qty_dropped', int),
+        ('qty_destroyed', int),
+        ('singleton', bool),
+        ('type_name', unicode),
+        ('group_name', unicode),
+        ('category_name', unicode),
+        ('flag_name', unicode),
+        ('bpc', bool),
+        ('value', float)
+    )
+    __slots__ = tuple(name for name, kind in _fields)
+
     def __init__(self):
         self.type_id = None
         self.flag_id = None
@@ -378,6 +1650,20 @@ class Item(SubEntity):
             return des + '%d destroyed' % self.qty_destroyed
 
 class GroupedItems(SubEntity):
+
+    _fields = (
+        ('highs', [Item]),
+        ('mids', [Item]),
+        ('lows', [Item]),
+        ('rigs', [Item]),
+        ('subsystems', [Item]),
+        ('drone_bay', [Item]),
+        ('cargo', [Item]),
+        ('fleet_hangar', [Item]),
+        ('specialized_hangar', [Item]),
+        ('implants', [Item])
+    )
+
     def __init__(self, items = None):
         self.highs = []
         self.mids = []
@@ -392,42 +1678,98 @@ class GroupedItems(SubEntity):
         if items is not None:
             self.add_all(items)
 
-    def _sub_entities(self):
-        return { key: Item for key in ['highs', 'mids', 'lows', 'rigs', 'subsystems',
-            'drone_bay', 'cargo', 'fleet_hangar', 'specialized_hangar', 'implants'] }
+    # Slot list for each flag name prefix.
+    _slot_prefixes = (
+        ('HiSlot', 'highs'),
+        ('MedSlot', 'mids'),
+        ('LoSlot', 'lows'),
+        ('RigSlot', 'rigs'),
+        ('SubSystem', 'subsystems'),
+        ('DroneBay', 'drone_bay'),
+        ('Cargo', 'cargo'),
+        ('FleetHangar', 'fleet_hangar'),
+        ('Specialized', 'specialized_hangar'),
+        ('Implant', 'implants')
+    )
+    # Slot list for each flag name seen so far, None for flags that are not in any slot.
+    _flag_slots = dict()
+
+    @classmethod
+    def _slot(cls, flag_name):
+        try:
+            return cls._flag_slots[flag_name]
+        except KeyError:
+            slot = None
+            for prefix, name in cls._slot_prefixes:
+                if flag_name is not None and flag_name.startswith(prefix):
+                    slot = name
+                    break
+            cls._flag_slots[flag_name] = slot
+            return slot
 
     def add_all(self, items):
         if items is None:
             return
-        def slotcmp(a, b):
-            t = cmp(a.flag_name, b.flag_name)
-            if t != 0:
-                return t
-            if a.category_name == 'Charge' and b.category_name != 'Charge':
-                return 1
-            if a.category_name != 'Charge' and b.category_name == 'Charge':
-                return -1
-            return 0
-
-        def slot(items, slotType):
-            res = filter((lambda i: i.flag_name.startswith(slotType)), items)
-            if len(res) == 0:
-                return None
-            return sorted(res, slotcmp)
-
-        self.highs = slot(items, 'HiSlot')
-        self.mids = slot(items, 'MedSlot')
-        self.lows = slot(items, 'LoSlot')
-        self.rigs = slot(items, 'RigSlot')
-        self.subsystems = slot(items, 'SubSystem')
-        self.drone_bay = slot(items, 'DroneBay')
-        self.cargo = slot(items, 'Cargo')
-        self.fleet_hangar = slot(items, 'FleetHangar')
-        self.specialized_hangar = slot(items, 'Specialized')
-        self.implants = slot(items, 'Implant')
+        slots = dict()
+        # Ordered by flag, with charges after the module they are loaded in.
+        for item in sorted(items, key = lambda i: (i.flag_name, i.category_name == 'Charge')):
+            slot = GroupedItems._slot(item.flag_name)
+            if slot is not None:
+                slots.setdefault(slot, []).append(item)
+        for prefix, slot in GroupedItems._slot_prefixes:
+            setattr(self, slot, slots.get(slot))
+
+class PaymentDetail(SubEntity):
+
+    _fields = (
+        ('payment_id', int),
+        ('kill_id', int),
+        ('amount', int)
+    )
+
+    def __init__(self, payment_id = None, kill_id = None, amount = None):
+        self.payment_id = payment_id
+        self.kill_id = kill_id
+        self.amount = amount
+
+    def __repr__(self):
+        return 'PaymentDetail(%d, %d, %d)' % (self.payment_id, self.kill_id, self.amount)
 
 class KillMail(RootEntity):
 
+    _fields = (
+        ('kill_id', int),
+        ('kill_time', datetime),
+        ('solar_system_id', int),
+        ('solar_system_name', unicode),
+        ('region_name', unicode),
+        ('victim_id', int),
+        ('victim', Victim),
+        ('attackers', [Attacker]),
+        ('final_blow', Attacker),
+        ('items', [Item]),
+        ('loss_mail', bool),
+        ('default_payment', int),
+        ('suggested_loss_type', unicode),
+        ('loss_type', unicode),
+        ('srp_amount', int),
+        ('paid_amount', int),
+        ('outstanding_amount', int),
+        ('crest_hash', unicode),
+        ('payments', [PaymentDetail]),
+        ('hull_value', float),
+        ('dropped_value', float),
+        ('destroyed_value', float),
+        ('total_value', float),
+        ('srpable', bool),
+        ('paid', bool),
+        ('srp_checked', bool)
+    )
+
+    # Killmails can be hundreds of KB each, so look them up in smaller batches.
+    _lookup_batch_keys = 100
+    _packed = ('attackers', 'items')
+
     def __init__(self, kill_id = None):
         self.kill_id = kill_id
         self.kill_time = None
@@ -439,7 +1781,6 @@ class KillMail(RootEntity):
         self.attackers = []
         self.final_blow = None
         self.items = []
-        self.grouped_items = None
         self.loss_mail = None
         self.default_payment = None
         self.suggested_loss_type = None
@@ -463,15 +1804,15 @@ class KillMail(RootEntity):
         self.outstanding_amount = (self.srp_amount or 0) - (self.paid_amount or 0)
         return self.kill_id
 
-    def _sub_entities(self):
-        return {
-            'victim': Victim,
-            'attackers': Attacker,
-            'final_blow': Attacker,
-            'items': Item,
-            'payments': PaymentDetail,
-            'grouped_items': GroupedItems
-        }
+    @property
+    def grouped_items(self):
+        """ The items grouped by slot.
+
+        This is worked out from items each time rather than stored. Older killmails that still have
+        grouped_items stored have it skipped on load and dropped on their next save.
+        """
+
+        return GroupedItems(self.items)
 
     def __repr__(self):
         return 'KillMail(%d)' % self.kill_id
@@ -506,93 +1847,62 @@ class KillMail(RootEntity):
 
     @classmethod
     def all_after(cls, kill_id):
-        _log.debug('KillMail.all_after(%d)', kill_id)
-
-        req = googledatastore.RunQueryRequest()
-        query = req.gql_query
+        _log.debug('KillMail.all_after(%s)', kill_id)
 
         if type(kill_id) is int:
-            query.query_string = ('SELECT * FROM KillMail ' +
-                    'WHERE kill_id > @killId ' +
-                    'ORDER BY kill_id ' +
-                    'LIMIT 50 OFFSET @startCursor ')
-            query.allow_literal = True
-
-            kill_id_arg = query.name_arg.add()
-            kill_id_arg.name = 'killId'
-            kill_id_arg.value.integer_value = kill_id
+            return cls.select().filter('kill_id', '>', kill_id).order('kill_id')
         else:
-            query.query_string = ('SELECT * FROM KillMail ' +
-                    'WHERE kill_time > @killTime ' +
-                    'ORDER BY kill_time ' +
-                    'LIMIT 50 OFFSET @startCursor ')
-            query.allow_literal = True
-
-            ts = _date_to_timestamp(kill_id)
-            kill_time_arg = query.name_arg.add()
-            kill_time_arg.name = 'killTime'
-            kill_time_arg.value.timestamp_microseconds_value = ts
-
-        return cls.query(req)
+            return cls.select().filter('kill_time', '>', kill_id).order('kill_time')
 
     @classmethod
     def losses_after(cls, date):
         _log.debug('KillMail.losses_after(%s)', date)
 
-        ts = _date_to_timestamp(date)
-
-        req = googledatastore.RunQueryRequest()
-        query = req.gql_query
-        query.query_string = ('SELECT * FROM KillMail ' +
-            'WHERE loss_mail = TRUE ' +
-            'AND kill_time > @date ' +
-            'ORDER BY kill_time, kill_id ' +
-            'LIMIT 50 OFFSET @startCursor ')
-        query.allow_literal = True
+        return (cls.select()
+                .filter('loss_mail', '=', True)
+                .filter('kill_time', '>', date)
+                .order('kill_time', 'kill_id'))
 
-        date_arg = query.name_arg.add()
-        date_arg.name = 'date'
-        date_arg.value.timestamp_microseconds_value = ts
+    def related_kills(self, back_minutes = 60, forward_minutes = 15, system_ids = None):
+        """ Kills in the given systems from back_minutes before to forward_minutes after this one.
 
-        return cls.query(req)
+        The systems are queried concurrently and the kills come back ordered by kill time.
+        """
 
-    def related_kills(self, back_minutes = 60, forward_minutes = 15, system_ids = None):
-        micros_per_minute = 60 * 1000000L
-        ts = _date_to_timestamp(self.kill_time)
-        start = ts - back_minutes * micros_per_minute
-        end = ts + forward_minutes * micros_per_minute
         if system_ids is None:
             system_ids = [self.solar_system_id]
-
-        for system in system_ids:
-            req = googledatastore.RunQueryRequest()
-            query = req.gql_query
-            query.query_string = ('SELECT * FROM KillMail ' +
-                    'WHERE solar_system_id = @system ' +
-                    'AND kill_time >= @startTime ' +
-                    'AND kill_time < @endTime ' +
-                    'ORDER BY kill_time, kill_id ')
-
-            system_arg = query.name_arg.add()
-            system_arg.name = 'system'
-            system_arg.value.integer_value = system
-
-            start_time_arg = query.name_arg.add()
-            start_time_arg.name = 'startTime'
-            start_time_arg.value.timestamp_microseconds_value = start
-
-            end_time_arg = query.name_arg.add()
-            end_time_arg.name = 'endTime'
-            end_time_arg.value.timestamp_microseconds_value = end
-
-            resp = googledatastore.run_query(req)
-            for result in resp.batch.entity_result:
-                entity = KillMail()
-                entity._set_entity(result.entity)
-                yield entity
+        return (KillMail.select()
+                .filter_in('solar_system_id', system_ids)
+                .filter('kill_time', '>=', self.kill_time - timedelta(minutes = back_minutes))
+                .filter('kill_time', '<', self.kill_time + timedelta(minutes = forward_minutes))
+                .order('kill_time', 'kill_id'))
 
 class LossMailAttributes(RootEntity):
 
+    _fields = (
+        ('kill_id', int),
+        ('character_id', int),
+        ('ship_type_id', int),
+        ('ship_group_id', int),
+        ('region_name', unicode),
+        ('empty_low_slots', bool),
+        ('empty_med_slots', bool),
+        ('empty_rig_slots', bool),
+        ('empty_hardpoints', bool),
+        ('exploration_mods', bool),
+        ('tackle_mods', bool),
+        ('local_rep', bool),
+        ('npcs_on_lossmail', bool),
+        ('players_on_lossmail', bool),
+        ('friendlies_on_lossmail', bool),
+        ('friendly_bombers_on_lossmail', bool),
+        ('recent_kills', bool),
+        ('recent_friendly_kills_nearby', bool),
+        ('recent_friendly_losses_nearby', bool),
+        ('home_region', bool),
+        ('cyno', bool)
+    )
+
     def __init__(self, loss_id = None):
         self.kill_id = loss_id
         self.character_id = None
@@ -630,39 +1940,17 @@ class LossMailAttributes(RootEntity):
     @classmethod
     def by_ship_type(cls, ship_type_id):
         _log.debug('LossMailAttributes.by_ship_type(%d)', ship_type_id)
-        cursor = None
-        while True:
-            req = googledatastore.RunQueryRequest()
-            query = req.gql_query
-            query.query_string = ('SELECT * FROM LossMailAttributes ' +
-                    'WHERE ship_type_id = @shipTypeId ' +
-                    'LIMIT 50 OFFSET @startCursor ')
-            query.allow_literal = True
-
-            ship_type_arg = query.name_arg.add()
-            ship_type_arg.name = 'shipTypeId'
-            ship_type_arg.value.integer_value = ship_type_id
-
-            cursor_arg = query.name_arg.add()
-            cursor_arg.name = 'startCursor'
-            if cursor is None:
-                cursor_arg.value.integer_value = 0
-            else:
-                cursor_arg.cursor = cursor
-
-            resp = googledatastore.run_query(req)
-            for result in resp.batch.entity_result:
-                entity = cls()
-                entity._set_entity(result.entity)
-                yield entity
-            if resp.batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS:
-                break
-            if len(resp.batch.entity_result) == 0:
-                break
-            cursor = resp.batch.end_cursor
+        return cls.select().filter('ship_type_id', '=', ship_type_id)
 
 class ShipClass(RootEntity):
 
+    _fields = (
+        ('ship_class', unicode),
+        ('fixed_reimbursement', int),
+        ('market_reimbursement_multiplier', float)
+    )
+    _cached = True
+
     def __init__(self, ship_class = None):
         self.ship_class = ship_class
         self.fixed_reimbursement = None
@@ -679,7 +1967,52 @@ class ShipClass(RootEntity):
     def __str__(self):
         return 'ShipClass %s' % self.ship_class
 
-class Character(RootEntity):
+class _SrpTotals(object):
+    """ Running SRP totals of a Character or Corporation, all in millions of ISK except isk_lost.
+
+    payments_made is what has been paid and payments_owed what has been asked for and not paid yet.
+    """
+
+    _fields = (
+        ('losses', int),
+        ('isk_lost', float),
+        ('srp_requested', int),
+        ('payments_made', int),
+        ('payments_owed', int)
+    )
+
+    def reset_totals(self):
+        self.losses = 0
+        self.isk_lost = 0.0
+        self.srp_requested = 0
+        self.payments_made = 0
+        self.payments_owed = 0
+
+    def add_loss(self, kill):
+        self.losses = (self.losses or 0) + 1
+        self.isk_lost = (self.isk_lost or 0.0) + (kill.total_value or 0.0)
+        self.add_srp(kill.srp_amount or 0)
+
+    def add_srp(self, amount):
+        self.srp_requested = (self.srp_requested or 0) + amount
+        self.payments_owed = (self.payments_owed or 0) + amount
+
+    def add_payment(self, amount):
+        self.payments_made = (self.payments_made or 0) + amount
+        self.payments_owed = (self.payments_owed or 0) - amount
+
+class Character(_SrpTotals, RootEntity):
+
+    _fields = (
+        ('character_id', int),
+        ('character_name', unicode),
+        ('corp_id', int),
+        ('corp_name', unicode),
+        ('alliance_id', int),
+        ('alliance_name', unicode),
+        ('declined_srp', bool)
+    )
+    _cached = True
 
     def __init__(self, character_id = None):
         self.character_id = character_id
@@ -689,6 +2022,9 @@ class Character(RootEntity):
         self.alliance_id = None
         self.alliance_name = None
         self.declined_srp = None
+        self.losses = None
+        self.isk_lost = None
+        self.srp_requested = None
         self.payments_made = None
         self.payments_owed = None
         if character_id is not None:
@@ -703,7 +2039,18 @@ class Character(RootEntity):
     def __str__(self):
         return 'Character %s' % self.character_name
 
-class Corporation(RootEntity):
+class Corporation(_SrpTotals, RootEntity):
+
+    _fields = (
+        ('corp_id', int),
+        ('corp_name', unicode),
+        ('alliance_id', int),
+        ('alliance_name', unicode),
+        ('srp', bool),
+        ('corp_ticker', unicode)
+    )
+    _cached = True
+
     def __init__(self, corp_id = None):
         self.corp_id = corp_id
         self.corp_name = None
@@ -711,6 +2058,11 @@ class Corporation(RootEntity):
         self.alliance_name = None
         self.srp = None
         self.corp_ticker = None
+        self.losses = None
+        self.isk_lost = None
+        self.srp_requested = None
+        self.payments_made = None
+        self.payments_owed = None
         if corp_id is not None:
             self.load()
 
@@ -723,8 +2075,86 @@ class Corporation(RootEntity):
     def __str__(self):
         return self.corp_name
 
+class SrpTotals(object):
+    """ Saves killmails and payments together with the SRP totals of their characters and corporations.
+
+    The totals are read in the same transaction that writes the killmail or payment, not from the
+    entity cache, so they always agree with the stored killmails and payments and changes made at the
+    same time by the web site are not lost.
+    """
+
+    @staticmethod
+    def owners(character_id, corp_id):
+        """ The Character and Corporation whose totals a loss or payment counts towards, not loaded. """
+
+        owners = []
+        if character_id:
+            character = Character()
+            character.character_id = character_id
+            owners.append(character)
+        if corp_id:
+            corporation = Corporation()
+            corporation.corp_id = corp_id
+            owners.append(corporation)
+        return owners
+
+    @staticmethod
+    def save_kill(kill, update_character = False):
+        """ Saves a killmail, adding it to the totals of the victim when it is a loss mail.
+
+        With update_character the victim's Character also gets the names from the killmail.
+        """
+
+        victim = kill.victim
+        owners = []
+        if kill.loss_mail:
+            owners = SrpTotals.owners(victim.character_id, victim.corporation_id)
+        elif update_character:
+            owners = SrpTotals.owners(victim.character_id, None)
+        if not owners:
+            kill.save()
+            return
+        def change(*owners):
+            for owner in owners:
+                if kill.loss_mail:
+                    owner.add_loss(kill)
+                if update_character and isinstance(owner, Character):
+                    owner.character_name = victim.character_name
+                    owner.corp_id = victim.corporation_id
+                    owner.corp_name = victim.corporation_name
+                    owner.alliance_id = victim.alliance_id
+                    owner.alliance_name = victim.alliance_name
+                    if owner.declined_srp is None:
+                        owner.declined_srp = False
+        RootEntity.transact(owners, change, also = [kill])
+
+    @staticmethod
+    def save_payment(payment, change):
+        """ Reloads a payment in a transaction with its owners, calls change(payment) and saves it.
+
+        If change marks an unpaid payment as paid, the payment is added to the totals of its owners.
+        Returns what change returned.
+        """
+
+        def pay(payment, *owners):
+            was_paid = payment.paid
+            result = change(payment)
+            if payment.paid and not was_paid:
+                for owner in owners:
+                    owner.add_payment(payment.payment_amount or 0)
+            return result
+        return RootEntity.transact([payment] + SrpTotals.owners(payment.character_id, payment.corp_id), pay)
+
 class Location(RootEntity):
 
+    _fields = (
+        ('location_id', int),
+        ('location_type', unicode),
+        ('location_name', unicode),
+        ('full_reimbursement', bool)
+    )
+    _cached = True
+
     def __init__(self, location_id = None):
         self.location_id = location_id
         self.location_type = None
@@ -744,6 +2174,23 @@ class Location(RootEntity):
 
 class Payment(RootEntity):
 
+    _fields = (
+        ('payment_id', int),
+        ('character_id', int),
+        ('character_name', unicode),
+        ('corp_id', int),
+        ('corp_name', unicode),
+        ('payment_amount', int),
+        ('paid', bool),
+        ('paid_date', datetime),
+        ('losses', [PaymentDetail]),
+        ('paid_by', int),
+        ('paid_by_name', unicode),
+        ('api_verified', bool),
+        ('api_amount', float),
+        ('ignore', bool)
+    )
+
     def __init__(self, payment_id = None):
         self.payment_id = payment_id
         self.character_id = None
@@ -774,85 +2221,32 @@ class Payment(RootEntity):
         else:
             return "Pay %d to %d" % (self.payment_amount, self.character_id)
 
-    def _sub_entities(self):
-        return {
-            'losses': PaymentDetail
-        }
-
     @classmethod
     def all_outstanding(cls):
         _log.debug('Payment.all_outstanding()')
-
-        cursor = None
-        while True:
-            req = googledatastore.RunQueryRequest()
-            query = req.gql_query
-            query.query_string = ('SELECT * FROM Payment ' +
-                'WHERE paid = FALSE ' +
-                'LIMIT 50 OFFSET @startCursor ')
-            query.allow_literal = True
-
-            cursor_arg = query.name_arg.add()
-            cursor_arg.name = 'startCursor'
-            if cursor is None:
-                cursor_arg.value.integer_value = 0
-            else:
-                cursor_arg.cursor = cursor
-
-            resp = googledatastore.run_query(req)
-            for result in resp.batch.entity_result:
-                entity = cls()
-                entity._set_entity(result.entity)
-                yield entity
-            if resp.batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS:
-                break
-            if len(resp.batch.entity_result) == 0:
-                break
-            cursor = resp.batch.end_cursor
+        return cls.select().filter('paid', '=', False)
 
     @classmethod
     def unverified_payments(cls):
         _log.debug('Payment.unverified_payments()')
+        return cls.select().filter('paid', '=', True).filter('api_verified', '=', False)
 
-        cursor = None
-        while True:
-            req = googledatastore.RunQueryRequest()
-            query = req.gql_query
-            query.query_string = ('SELECT * FROM Payment ' +
-                    'WHERE paid = TRUE ' +
-                    'AND api_verified = FALSE ' +
-                    'LIMIT 50 OFFSET @startCursor ')
-            query.allow_literal = True
-
-            cursor_arg = query.name_arg.add()
-            cursor_arg.name = 'startCursor'
-            if cursor is None:
-                cursor_arg.value.integer_value = 0
-            else:
-                cursor_arg.cursor = cursor
-
-            resp = googledatastore.run_query(req)
-            for result in resp.batch.entity_result:
-                entity = cls()
-                entity._set_entity(result.entity)
-                yield entity
-            if resp.batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS:
-                break
-            if len(resp.batch.entity_result) == 0:
-                break
-            cursor = resp.batch.end_cursor
-
-class PaymentDetail(SubEntity):
-
-    def __init__(self, payment_id = None, kill_id = None, amount = None):
-        self.payment_id = payment_id
-        self.kill_id = kill_id
-        self.amount = amount
+class Silo(SubEntity):
 
-    def __repr__(self):
-        return 'PaymentDetail(%d, %d, %d)' % (self.payment_id, self.kill_id, self.amount)
+    _fields = (
+        ('silo_id', int),
+        ('name', unicode),
+        ('silo_type_id', int),
+        ('silo_type_name', unicode),
+        ('content_type_id', int),
+        ('content_type_name', unicode),
+        ('input', bool),
+        ('qty', int),
+        ('capacity', int),
+        ('hourly_usage', int),
+        ('content_size', float)
+    )
 
-class Silo(SubEntity):
     def __init__(self):
         self.silo_id = None
         self.name = None
@@ -871,6 +2265,15 @@ class Silo(SubEntity):
         return self.qty * self.content_size
 
 class Reactant(SubEntity):
+
+    _fields = (
+        ('reactant_type_id', int),
+        ('reactant_type_name', unicode),
+        ('reaction_qty', int),
+        ('connected_to', int),
+        ('item_size', float)
+    )
+
     def __init__(self):
         self.reactant_type_id = None
         self.reactant_type_name = None
@@ -882,6 +2285,17 @@ class Reactant(SubEntity):
         return 'Reactant %s: %s' % (self.reactant_type_name, self.reaction_qty)
 
 class Reactor(SubEntity):
+
+    _fields = (
+        ('reactor_id', int),
+        ('name', unicode),
+        ('reactor_type_id', int),
+        ('reactor_type_name', unicode),
+        ('reaction_type_id', int),
+        ('reaction_type_name', unicode),
+        ('reactants', [Reactant])
+    )
+
     def __init__(self):
         self.reactor_id = None
         self.name = None
@@ -891,10 +2305,48 @@ class Reactor(SubEntity):
         self.reaction_type_name = None
         self.reactants = []
 
-    def _sub_entities(self):
-        return { "reactants": Reactant }
-
 class Tower(RootEntity):
+
+    _fields = (
+        ('pos_id', int),
+        ('pos_name', unicode),
+        ('system_id', int),
+        ('system_name', unicode),
+        ('constellation_id', int),
+        ('constellation_name', unicode),
+        ('region_id', int),
+        ('region_name', unicode),
+        ('planet', int),
+        ('moon', int),
+        ('x', float),
+        ('y', float),
+        ('z', float),
+        ('corp_id', int),
+        ('corp_name', unicode),
+        ('corp_ticker', unicode),
+        ('pos_type_id', int),
+        ('pos_type_name', unicode),
+        ('fuel_type_id', int),
+        ('fuel_type_name', unicode),
+        ('fuel_hourly_usage', int),
+        ('fuel_qty', int),
+        ('stront_hourly_usage', int),
+        ('stront_qty', int),
+        ('next_tick', datetime),
+        ('status', unicode),
+        ('harvesters', list),
+        ('silos', [Silo]),
+        ('reactors', [Reactor]),
+        ('owner_type', unicode),
+        ('owner_id', int),
+        ('owner_name', unicode),
+        ('fuel_bay_capacity', int),
+        ('stront_bay_capacity', int),
+        ('guns', [Silo]),
+        ('deleted', bool),
+        ('jumps_to_staging', int)
+    )
+
     def __init__(self, pos_id = None):
         self.pos_id = pos_id
         self.pos_name = 'Unknown POS'
@@ -932,15 +2384,13 @@ class Tower(RootEntity):
         self.stront_bay_capacity = None
         self.guns = []
         self.deleted = False
+        self.jumps_to_staging = None
         if pos_id is not None:
             self.load()
 
     def _get_id(self):
         return self.pos_id
 
-    def _sub_entities(self):
-        return { 'silos': Silo, 'reactors': Reactor, 'guns': Silo }
-
     @property
     def location_str(self):
         def roman(n): # Pretty sure no systems in Eve have >= 40 planets...
@@ -965,7 +2415,7 @@ class Tower(RootEntity):
         name_filter.property.name = 'pos_name'
         name_filter.operator = googledatastore.PropertyFilter.EQUAL
         name_filter.value.string_value = name
-        resp = googledatastore.run_query(req)
+        resp = _run_query(req)
         if resp.batch.entity_result:
             tower = Tower()
             tower._set_entity(resp.batch.entity_result[0].entity)
@@ -974,10 +2424,42 @@ class Tower(RootEntity):
 
 class Control(RootEntity):
 
+    _fields = (
+        ('next_payment_id', int),
+        ('payment_id_gaps', list)
+    )
+
     def __init__(self):
         self.next_payment_id = 1
+        self.payment_id_gaps = []
         self.load()
 
+    def reserve_payment_ids(self, count):
+        """ Takes count payment ids in one transaction, reusing released ids first. """
+
+        def reserve(control):
+            gaps = control.payment_id_gaps or []
+            ids = gaps[:count]
+            control.payment_id_gaps = gaps[count:]
+            first = control.next_payment_id
+            control.next_payment_id += count - len(ids)
+            return ids + range(first, control.next_payment_id)
+        return self._transact(reserve)
+
+    def release_payment_ids(self, ids):
+        """ Gives back reserved payment ids that were not used, in one transaction.
+
+        Ids at the end of the reserved range go back to next_payment_id, any others are kept as gaps
+        to be reserved again.
+        """
+
+        def release(control):
+            unused = sorted(ids, reverse = True)
+            while unused and unused[0] == control.next_payment_id - 1:
+                control.next_payment_id = unused.pop(0)
+            control.payment_id_gaps = sorted((control.payment_id_gaps or []) + unused)
+        self._transact(release)
+
     def _get_id(self):
         return 1
 
@@ -987,8 +2469,68 @@ class Control(RootEntity):
     def __str__(self):
         return "next_payment_id: %d" % self.next_payment_id
 
+class PaymentIdAllocator(object):
+    """ Hands out payment ids from blocks reserved on Control, so each new payment doesn't need a
+    transaction of its own. Ids left over are released when the allocator is closed.
+
+        with PaymentIdAllocator() as payment_ids:
+            payment = Payment(payment_ids.peek())
+            if keep(payment):
+                payment_ids.next()
+    """
+
+    def __init__(self, block_size = None):
+        self.block_size = block_size or _int_option('payment_id_block', 20)
+        self._control = None
+        self._ids = deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def peek(self):
+        """ Get the id next() will return, reserving a block first if needed. """
+
+        if not self._ids:
+            if self._control is None:
+                self._control = Control()
+            self._ids.extend(self._control.reserve_payment_ids(self.block_size))
+            _log.debug('Reserved payment ids %s.', list(self._ids))
+        return self._ids[0]
+
+    def next(self):
+        """ Take a payment id. """
+
+        self.peek()
+        return self._ids.popleft()
+
+    def close(self):
+        """ Release the ids that were reserved and not taken. """
+
+        if self._ids:
+            _log.debug('Releasing payment ids %s.', list(self._ids))
+            self._control.release_payment_ids(list(self._ids))
+            self._ids.clear()
+
 class Configuration(RootEntity):
 
+    _fields = (
+        ('version', unicode),
+        ('client_id', unicode),
+        ('auth_header', unicode),
+        ('base_uri', unicode),
+        ('redirect_uri', unicode),
+        ('scopes', unicode),
+        ('srp_admins', list),
+        ('srp_payers', list),
+        ('super_admins', list),
+        ('alliance_id', int),
+        ('pos_admins', list)
+    )
+
     def __init__(self, version = None):
         self.version = version
         self.client_id = None
@@ -0,0 +1,193 @@
+import os
+import json
+import base64
+import logging
+import threading
+import time
+import googledatastore
+from config import ConfigSection
+from datastore import RootEntity, Query, _make_key
+
+_config = ConfigSection('migration')
+_log = logging.getLogger('sound.srp.be.migration')
+
+def _option(name, default):
+    value = _config.get_option(name)
+    return type(default)(value) if value else default
+
+def key_shards(cls, count, start, end):
+    """ Splits the integer keys of a kind from start up to and including end into count ranges.
+
+    The lowest key of the kind is used when start is None. end has to be given: finding the highest
+    key would need a descending __key__ index, which the datastore doesn't build by default.
+    """
+
+    if start is None:
+        start = next(iter(Query(cls).order('__key__').page_size(1).ids()), None)
+    if start is None or end < start:
+        return []
+    size = max(1, (end - start + count) // count)
+    return [('__key__', _make_key(cls.__name__, low), _make_key(cls.__name__, min(low + size, end + 1)))
+            for low in range(start, end + 1, size)]
+
+def time_shards(field, start, end, count):
+    """ Splits the time from start up to end into count ranges of the given datetime field. """
+
+    size = (end - start) // count
+    bounds = [start + size * index for index in range(count)] + [end]
+    return [(field, low, high) for low, high in zip(bounds, bounds[1:]) if low < high]
+
+def _describe(value):
+    if hasattr(value, 'path_element'):
+        return str(value.path_element[-1].id)
+    return str(value)
+
+class _Throttle(object):
+    """ Token bucket shared by the shard workers that limits the entities written per second. """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self._allowance = rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def wait(self, count):
+        if self.rate <= 0 or count == 0:
+            return
+        with self._lock:
+            now = time.time()
+            self._allowance = min(self.rate, self._allowance + (now - self._last) * self.rate)
+            self._last = now
+            self._allowance -= count
+            if self._allowance < 0:
+                time.sleep(-self._allowance / self.rate)
+
+class _Checkpoint(object):
+    """ The progress of each shard, kept in a JSON file so that an interrupted run can resume. """
+
+    def __init__(self, path, shards):
+        self.path = path
+        self._lock = threading.Lock()
+        bounds = [[field, _describe(low), _describe(high)] for field, low, high in shards]
+        self.state = { 'shards': bounds, 'progress': {} }
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            if state['shards'] != bounds:
+                raise ValueError('Checkpoint %s was written for different shards.' % path)
+            self.state = state
+            _log.info('Resuming from checkpoint %s.', path)
+
+    def progress(self, shard):
+        return self.state['progress'].get(str(shard), { 'cursor': None, 'done': False,
+                'processed': 0, 'saved': 0 })
+
+    def cursor(self, shard):
+        cursor = self.progress(shard)['cursor']
+        return base64.b64decode(cursor) if cursor else None
+
+    def update(self, shard, cursor, done, processed, saved):
+        with self._lock:
+            self.state['progress'][str(shard)] = { 'cursor': base64.b64encode(cursor) if cursor else None,
+                    'done': done, 'processed': processed, 'saved': saved }
+            temp = self.path + '.tmp'
+            with open(temp, 'w') as f:
+                json.dump(self.state, f, indent = 1)
+            os.rename(temp, self.path)
+
+class Migration(object):
+    """ Runs a transform over every entity of a kind, split into shards that are processed in parallel.
+
+        shards = migration.key_shards(KillMail, 8, 45547001, last_kill_id)
+        Migration('fix_final_blow', KillMail, fix_final_blow, shards).run()
+
+    Each shard is a (field, low, high) range from key_shards or time_shards, queried in field order.
+    The transform changes the entity it is given in place, entities that it changed are saved with
+    RootEntity.bulk_save a page at a time. After each page the cursor of the shard is written to
+    name.checkpoint.json, and running the same migration again carries on from there.
+    The workers and writes_per_second options of the migration section are used unless given.
+    """
+
+    def __init__(self, name, cls, transform, shards, workers = None, writes_per_second = None):
+        self.name = name
+        self.cls = cls
+        self.transform = transform
+        self.shards = shards
+        self.workers = workers or _option('workers', 4)
+        if writes_per_second is None:
+            writes_per_second = _option('writes_per_second', 200.0)
+        self._throttle = _Throttle(float(writes_per_second))
+        self._checkpoint = _Checkpoint('%s.checkpoint.json' % name, shards)
+        self._stop = threading.Event()
+        self._failed = []
+
+    def _query(self, index):
+        field, low, high = self.shards[index]
+        query = Query(self.cls).filter(field, '>=', low).filter(field, '<', high).order(field)
+        cursor = self._checkpoint.cursor(index)
+        if cursor is not None:
+            query.start(cursor)
+        return query
+
+    def _run_shard(self, index):
+        progress = self._checkpoint.progress(index)
+        if progress['done']:
+            return
+        processed = progress['processed']
+        saved = progress['saved']
+        _log.info('%s: starting shard %d after %d entities.', self.name, index, processed)
+        for batch in self._query(index).pages():
+            entities = []
+            for result in batch.entity_result:
+                entity = self.cls()
+                entity._set_entity(result.entity)
+                self.transform(entity)
+                entities.append(entity)
+            changed = RootEntity.dirty(entities)
+            self._throttle.wait(len(changed))
+            RootEntity.bulk_save(changed)
+            processed += len(entities)
+            saved += len(changed)
+            done = len(batch.entity_result) == 0 or batch.more_results == googledatastore.QueryResultBatch.NO_MORE_RESULTS
+            self._checkpoint.update(index, batch.end_cursor, done, processed, saved)
+            if done or self._stop.is_set():
+                break
+        _log.info('%s: shard %d stopped after %d entities, %d saved.', self.name, index, processed, saved)
+
+    def _work(self, pending):
+        while not self._stop.is_set():
+            try:
+                index = pending.pop()
+            except IndexError:
+                return
+            try:
+                self._run_shard(index)
+            except Exception:
+                _log.exception('%s: shard %d failed.', self.name, index)
+                self._failed.append(index)
+
+    def run(self):
+        """ Processes the shards that are not done yet and returns the indexes of the failed ones. """
+
+        _log.info('%s: migrating %d shards of %s with %d workers.', self.name, len(self.shards),
+                self.cls.__name__, self.workers)
+        pending = list(reversed(range(len(self.shards))))
+        threads = [threading.Thread(target = self._work, args = (pending,),
+                name = 'migration-%d' % index) for index in range(self.workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        try:
+            # Join with a timeout so that Ctrl-C still reaches the main thread.
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(1)
+        except KeyboardInterrupt:
+            _log.warning('%s: stopping after the current pages, run again to resume.', self.name)
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            raise
+        if self._failed:
+            _log.error('%s: shards %s failed, run again to retry them.', self.name, sorted(self._failed))
+        return sorted(self._failed)
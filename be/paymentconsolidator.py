@@ -1,13 +1,54 @@
 import logging
 import sys
 from config import ConfigSection
-from datastore import Character, Corporation, KillMail, Payment, PaymentDetail, Control
+from datastore import Character, Corporation, KillMail, Payment, PaymentDetail, PaymentIdAllocator, Session
 from datetime import datetime, timedelta
 import eveapi
 
 _config = ConfigSection('paymentconsolidator')
 _log = logging.getLogger('sound.srp.be.paymentconsolidator')
 
+# A payment is marked paid in one cross group transaction with its character, corporation and
+# killmails, which may touch 25 entity groups, so a payment pays for at most this many losses.
+_max_losses = 22
+
+def new_payment(payment_id, character_id, character_name, corp_id, corp_name):
+    p = Payment(payment_id)
+    p.character_id = character_id
+    p.character_name = character_name
+    p.corp_id = corp_id
+    p.corp_name = corp_name
+    p.payment_amount = 0
+    return p
+
+def split(payment, payment_ids):
+    """ Moves the losses of an outstanding payment beyond _max_losses onto new payments for the same
+    character, returning the new payments.
+    """
+
+    extra = payment.losses[_max_losses:]
+    _log.info('Splitting %d losses off payment %d.' % (len(extra), payment.payment_id))
+    del payment.losses[_max_losses:]
+    payment.payment_amount -= sum([det.amount for det in extra])
+    payment.save()
+    parts = []
+    for start in range(0, len(extra), _max_losses):
+        part = new_payment(payment_ids.next(), payment.character_id, payment.character_name,
+                payment.corp_id, payment.corp_name)
+        part.ignore = payment.ignore
+        for det in extra[start:start + _max_losses]:
+            kill = KillMail(det.kill_id)
+            for kill_det in kill.payments:
+                if kill_det.payment_id == payment.payment_id:
+                    kill_det.payment_id = part.payment_id
+            kill.save()
+            det.payment_id = part.payment_id
+            part.losses.append(det)
+            part.payment_amount += det.amount
+        part.save()
+        parts.append(part)
+    return parts
+
 def process(kill, payment):
     if kill.srp_amount is None:
         return False
@@ -48,35 +89,54 @@ def run():
         return
     look_back_days = int(_config.get_option('look_back_days'))
     _log.info('Consolidating payments for losses for the past %d days.' % look_back_days)
-    outstanding_payments = { p.character_id: p for p in Payment.all_outstanding() }
-    start_time = datetime.now() - timedelta(look_back_days)
-    control = Control()
-    for kill in KillMail.losses_after(start_time):
-        cid = kill.victim.character_id
-        if cid not in outstanding_payments:
-            _log.info('Creating new payment for character %d.' % cid)
-            p = Payment(control.next_payment_id)
-            p.character_id = cid
-            p.character_name = kill.victim.character_name
-            p.corp_id = kill.victim.corporation_id
-            p.corp_name = kill.victim.corporation_name
-            p.payment_amount = 0
-            if process(kill, p):
-                control.next_payment_id += 1
-                outstanding_payments[cid] = p
-                control.save()
-        else:
-            process(kill, outstanding_payments[cid])
-    _log.info('Checking for out of alliance / declining SRP.')
-    alliance_id = int(_config.get_option('alliance_id'))
-    for cid, payment in outstanding_payments.iteritems():
-        c = Character(cid)
-        eveapi.update_character(c)
-        corp = Corporation(c.corp_id)
-        ignore = c.alliance_id != alliance_id or c.declined_srp or not corp.srp
-        if ignore != payment.ignore:
-            payment.ignore = ignore
-            payment.save()
+    with Session() as session, PaymentIdAllocator() as payment_ids:
+        outstanding = {}
+        for p in Payment.all_outstanding():
+            outstanding[p.payment_id] = p
+            if len(p.losses) > _max_losses:
+                for part in split(p, payment_ids):
+                    outstanding[part.payment_id] = part
+        # Write the killmails moved by a split before they are read again below.
+        session.flush()
+        # The outstanding payment of each character that new losses are added to.
+        open_payments = {}
+        for p in outstanding.itervalues():
+            if len(p.losses) < _max_losses:
+                open_payments[p.character_id] = p
+        start_time = datetime.now() - timedelta(look_back_days)
+        for kill in KillMail.losses_after(start_time):
+            cid = kill.victim.character_id
+            # A loss already on an outstanding payment stays on it.
+            current = [outstanding[det.payment_id] for det in kill.payments or []
+                    if det.payment_id in outstanding]
+            if current:
+                process(kill, current[0])
+            elif cid not in open_payments:
+                _log.info('Creating new payment for character %d.' % cid)
+                p = new_payment(payment_ids.peek(), cid, kill.victim.character_name,
+                        kill.victim.corporation_id, kill.victim.corporation_name)
+                if process(kill, p):
+                    payment_ids.next()
+                    outstanding[p.payment_id] = p
+                    open_payments[cid] = p
+            else:
+                p = open_payments[cid]
+                process(kill, p)
+                if len(p.losses) >= _max_losses:
+                    del open_payments[cid]
+        _log.info('Checking for out of alliance / declining SRP.')
+        alliance_id = int(_config.get_option('alliance_id'))
+        ignored = {}
+        for payment in outstanding.itervalues():
+            cid = payment.character_id
+            if cid not in ignored:
+                c = Character(cid)
+                eveapi.update_character(c)
+                corp = Corporation(c.corp_id)
+                ignored[cid] = c.alliance_id != alliance_id or c.declined_srp or not corp.srp
+            if ignored[cid] != payment.ignore:
+                payment.ignore = ignored[cid]
+                payment.save()
 
 if __name__ == '__main__':
     run()
@@ -1,6 +1,6 @@
 import logging
 from config import ConfigSection
-from datastore import Payment
+from datastore import Payment, SrpTotals
 from datetime import datetime, timedelta
 from evelink.api import API, APIError
 from evelink.cache.shelf import ShelveCache
@@ -50,13 +50,15 @@ def verify_payments():
                 _log.critical('Payment %d paid to %s when it should have been to %s.' % (
                     paymentId, journalEntry['party_2']['name'], payment.character_name))
                 continue
-            payment.paid = True
-            payment.paid_date = datetime.utcfromtimestamp(journalEntry['timestamp'])
-            payment.paid_by = journalEntry['arg']['id']
-            payment.paid_by_name = journalEntry['arg']['name']
-            payment.api_amount = -journalEntry['amount']
-            payment.api_verified = True
-            payment.save()
+            def verify(payment):
+                payment.paid = True
+                payment.paid_date = datetime.utcfromtimestamp(journalEntry['timestamp'])
+                payment.paid_by = journalEntry['arg']['id']
+                payment.paid_by_name = journalEntry['arg']['name']
+                payment.api_amount = -journalEntry['amount']
+                payment.api_verified = True
+            # Marks the payment paid and adds it to the totals in one transaction.
+            SrpTotals.save_payment(payment, verify)
             _log.info('Payment %d (%dM to %s) verified.' % (
                 paymentId, payment.payment_amount, payment.character_name))
             if payment.api_amount != payment.payment_amount * 1000000:
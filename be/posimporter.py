@@ -12,7 +12,7 @@ import sys
 from config import ConfigSection
 from datastore import Corporation, Tower, Reactor, Reactant, Silo
 from eveapi import get_api_key, get_key_config
-from staticdata import InvType, InvGroup, InvTypeReaction, InvControlTowerResource, DgmAttributeTypes, DgmTypeAttributes, MapDenormalize
+from staticdata import InvType, InvGroup, InvTypeReaction, InvControlTowerResource, DgmAttributeTypes, DgmTypeAttributes, MapDenormalize, MapSolarSystem, jump_graph
 
 one_hour = timedelta(hours = 1)
 _config = ConfigSection('posimporter')
@@ -20,6 +20,17 @@ _log = logging.getLogger('sound.posmon.be.main')
 
 multiplierAttribute = DgmAttributeTypes.by_name('moonMiningAmount')
 
+def _staging_system():
+    name = _config.get_option('staging_system')
+    if not name:
+        return None
+    system = MapSolarSystem.by_name(name)
+    if system is None:
+        raise ValueError('The staging_system option of the posimporter section is %r, which is not a known solar system.' % name)
+    return system
+
+staging_system = _staging_system()
+
 def find(predicate, collection):
     if not collection: return None, None
     for idx, elem in enumerate(collection):
@@ -71,6 +82,8 @@ def build_tower(starbase, detail, location_info, fuel_info, corp_id, corp_name,
     tower.fuel_bay_capacity = int(posType.capacity)
     tower.stront_bay_capacity = int(tower.fuel_bay_capacity / 2.8)
     tower.deleted = False
+    if staging_system is not None:
+        tower.jumps_to_staging = jump_graph().distance(staging_system.solarSystemID, tower.system_id)
 
     sov_bonus = 0.75 if sov.has_key(tower.system_id) else 1.0
     for fuel in fuel_info:
@@ -111,8 +124,8 @@ def get_locations(corp, ids):
 
 def get_pos_modules(corp, assets):
     _log.debug('Getting POS modules')
-    silos = map(lambda silo: silo.typeID, InvGroup.by_id(404).types.all() + InvGroup.by_id(707).types.all())
-    guns = map(lambda module: module.typeID, InvGroup.by_id(417).types.all() + InvGroup.by_id(426).types.all() + InvGroup.by_id(430).types.all() + InvGroup.by_id(449).types.all())
+    silos = map(lambda silo: silo.typeID, InvGroup.by_id(404).types + InvGroup.by_id(707).types)
+    guns = map(lambda module: module.typeID, InvGroup.by_id(417).types + InvGroup.by_id(426).types + InvGroup.by_id(430).types + InvGroup.by_id(449).types)
     reactors = map(lambda reactor: reactor.typeID, InvGroup.by_id(438).types)
     harvesters = map(lambda harvester: harvester.typeID, InvGroup.by_id(416).types)
     modules = {}
@@ -0,0 +1,234 @@
+import sys
+import sha
+import time
+import atexit
+import cPickle
+import logging
+import runpy
+import threading
+import urllib2
+from collections import deque
+import googledatastore
+import web
+from config import ConfigSection
+
+_config = ConfigSection('replay')
+_log = logging.getLogger('sound.srp.be.replay')
+
+_responses = {
+    'lookup': 'LookupResponse',
+    'run_query': 'RunQueryResponse',
+    'begin_transaction': 'BeginTransactionResponse',
+    'commit': 'CommitResponse',
+    'rollback': 'RollbackResponse',
+}
+
+class _Tape(object):
+    """ The responses recorded for one kind of request, in the order they were made.
+
+    A response recorded for the same request is served first. When fallback is set, the next unused
+    response is served otherwise, so queries that change from run to run, like queries for the last
+    few days, still get served.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, digest, value):
+        self.entries.append((digest, value))
+
+    def rewind(self):
+        self._used = set()
+        self._order = deque(range(len(self.entries)))
+        self._by_digest = {}
+        for index, (digest, value) in enumerate(self.entries):
+            self._by_digest.setdefault(digest, deque()).append(index)
+
+    def _next(self, indexes):
+        while indexes:
+            index = indexes.popleft()
+            if index not in self._used:
+                self._used.add(index)
+                return index
+        return None
+
+    def take(self, digest, fallback = False):
+        index = self._next(self._by_digest.get(digest, deque()))
+        if index is None and fallback:
+            index = self._next(self._order)
+        if index is None:
+            same = [value for entry_digest, value in self.entries if entry_digest == digest]
+            if not same:
+                return None
+            return same[-1]
+        return self.entries[index][1]
+
+class Recording(object):
+    """ Datastore, web and EVE API responses by channel and request shape, saved to a pickle file. """
+
+    def __init__(self):
+        self.tapes = {}
+        self._lock = threading.Lock()
+
+    def add(self, channel, shape, digest, value):
+        with self._lock:
+            self.tapes.setdefault((channel, shape), _Tape()).add(digest, value)
+
+    def take(self, channel, shape, digest, fallback = False):
+        with self._lock:
+            tape = self.tapes.get((channel, shape))
+            return tape.take(digest, fallback) if tape is not None else None
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            cPickle.dump(self.tapes, f, cPickle.HIGHEST_PROTOCOL)
+        _log.info('Recorded %d responses to %s.', sum(len(tape.entries) for tape in self.tapes.itervalues()), path)
+
+    @staticmethod
+    def load(path):
+        recording = Recording()
+        with open(path, 'rb') as f:
+            recording.tapes = cPickle.load(f)
+        for tape in recording.tapes.itervalues():
+            tape.rewind()
+        return recording
+
+def _shape(method, req):
+    if method == 'run_query':
+        return req.gql_query.query_string or str(req.query)
+    return method
+
+def _empty_response(method, req):
+    resp = getattr(googledatastore, _responses[method])()
+    if method == 'lookup':
+        for key in req.key:
+            resp.missing.add().entity.key.CopyFrom(key)
+    elif method == 'run_query':
+        resp.batch.entity_result_type = googledatastore.EntityResult.FULL
+        resp.batch.more_results = googledatastore.QueryResultBatch.NO_MORE_RESULTS
+    return resp
+
+def _datastore_call(method, original, recording, replaying, latency):
+    def call(req):
+        shape = _shape(method, req)
+        digest = sha.new(req.SerializeToString()).hexdigest()
+        if not replaying:
+            resp = original(req)
+            recording.add('datastore', shape, digest, resp.SerializeToString())
+            return resp
+        time.sleep(latency)
+        # Only queries fall back to other recorded responses, a lookup or commit for other keys must
+        # not be answered with the entities recorded for those.
+        data = recording.take('datastore', shape, digest, fallback = method == 'run_query')
+        if data is None:
+            if method in ('lookup', 'run_query'):
+                _log.warning('No recorded %s response for: %s', method, shape)
+            return _empty_response(method, req)
+        resp = getattr(googledatastore, _responses[method])()
+        resp.ParseFromString(data)
+        return resp
+    return call
+
+def _fetch_url(original, recording, replaying, latency):
+    def fetch_url(path):
+        if not replaying:
+            content = original(path)
+            recording.add('web', path, path, content)
+            return content
+        time.sleep(latency)
+        content = recording.take('web', path, path)
+        if content is None:
+            raise urllib2.URLError('No recorded response for %s' % path)
+        return content
+    return fetch_url
+
+class _EvelinkCache(object):
+    """ Wraps the cache of an evelink API to record the responses it caches, or serve recorded ones.
+
+    When replaying, a request that was not recorded raises URLError rather than going to the EVE API.
+    """
+
+    def __init__(self, cache, recording, replaying, latency):
+        self.cache = cache
+        self.recording = recording
+        self.replaying = replaying
+        self.latency = latency
+
+    def get(self, key):
+        if self.replaying:
+            time.sleep(self.latency)
+            value = self.recording.take('evelink', key, key)
+            if value is None:
+                raise urllib2.URLError('No recorded EVE API response for %s' % key)
+            return value
+        value = self.cache.get(key)
+        if value is not None:
+            self.recording.add('evelink', key, key, value)
+        return value
+
+    def put(self, key, value, duration):
+        if not self.replaying:
+            self.recording.add('evelink', key, key, value)
+            self.cache.put(key, value, duration)
+
+def install(recording, replaying, datastore_latency = 0.0, web_latency = 0.0):
+    """ Routes datastore RPCs, web.fetch_url and evelink API caches through the recording.
+
+    Must be called before the job makes any requests. The latencies are in seconds and are added to
+    every replayed response.
+    """
+
+    for method in _responses:
+        setattr(googledatastore, method, _datastore_call(method, getattr(googledatastore, method),
+                recording, replaying, datastore_latency))
+    web.fetch_url = _fetch_url(web.fetch_url, recording, replaying, web_latency)
+    import evelink.api
+    init = evelink.api.API.__init__
+    def __init__(api, *args, **kwargs):
+        init(api, *args, **kwargs)
+        api.cache = _EvelinkCache(api.cache, recording, replaying, web_latency)
+    evelink.api.API.__init__ = __init__
+
+def _float_option(name, default):
+    value = _config.get_option(name)
+    return float(value) if value else default
+
+def run():
+    """ replay.py record|replay [-f file] [-d ms] [-w ms] module [args...]
+
+    Runs module as a script, recording its requests to file, or serving them from file with
+    -d milliseconds added to every datastore response and -w to every web and EVE API response.
+    """
+
+    args = sys.argv[1:]
+    if not args or args[0] not in ('record', 'replay'):
+        print run.__doc__
+        sys.exit(2)
+    replaying = args.pop(0) == 'replay'
+    path = _config.get_option('path') or 'replay.pickle'
+    datastore_latency = _float_option('datastore_latency_ms', 0.0)
+    web_latency = _float_option('web_latency_ms', 0.0)
+    while args and args[0] in ('-f', '-d', '-w'):
+        flag, value = args.pop(0), args.pop(0)
+        if flag == '-f':
+            path = value
+        elif flag == '-d':
+            datastore_latency = float(value)
+        else:
+            web_latency = float(value)
+    module = args.pop(0)
+    if replaying:
+        recording = Recording.load(path)
+    else:
+        recording = Recording()
+        atexit.register(recording.save, path)
+    install(recording, replaying, datastore_latency / 1000, web_latency / 1000)
+    sys.argv = [module + '.py'] + args
+    start = time.time()
+    try:
+        runpy.run_module(module, run_name = '__main__', alter_sys = True)
+    finally:
+        print '%s %s in %.3fs.' % ('Replayed' if replaying else 'Recorded', module, time.time() - start)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,45 @@
+import logging
+from datastore import Character, Corporation, KillMail, Payment, RootEntity, SrpTotals, _SrpTotals
+
+_log = logging.getLogger('sound.srp.be.srptotals')
+
+def rebuild():
+    """ Works out the SRP totals of every character and corporation again from the killmails and
+    payments, for when the running totals have drifted or after a change to how they are counted.
+
+    The totals are counted first and then written one owner at a time, each in a transaction that
+    only replaces the totals fields.
+    """
+
+    _log.info('Rebuilding SRP totals.')
+    totals = {}
+    for cls in (Character, Corporation):
+        for entity in cls.all():
+            totals[(cls, entity._get_id())] = entity
+            entity.reset_totals()
+    def owners(character_id, corp_id):
+        for owner in SrpTotals.owners(character_id, corp_id):
+            owner = totals.setdefault((type(owner), owner._get_id()), owner)
+            if owner.losses is None:
+                owner.reset_totals()
+            yield owner
+    losses = 0
+    for kill in KillMail.select().filter('loss_mail', '=', True):
+        for owner in owners(kill.victim.character_id, kill.victim.corporation_id):
+            owner.add_loss(kill)
+        losses += 1
+    payments = 0
+    for payment in Payment.select().filter('paid', '=', True):
+        for owner in owners(payment.character_id, payment.corp_id):
+            owner.add_payment(payment.payment_amount or 0)
+        payments += 1
+    _log.info('Counted %d losses and %d paid payments.', losses, payments)
+    names = [name for name, _ in _SrpTotals._fields]
+    for counted in totals.values():
+        def replace(owner, counted = counted):
+            for name in names:
+                setattr(owner, name, getattr(counted, name))
+        RootEntity.transact([counted], replace)
+
+if __name__ == '__main__':
+    rebuild()
@@ -1,38 +1,352 @@
+import os
+import sys
 import logging
+import atexit
+import cPickle
+import bisect
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
 from beaker.cache import CacheManager
 from beaker.util import parse_cache_config_options
 from config import ConfigSection
+import sqlalchemy
 from sqlalchemy import *
 from sqlalchemy.orm import create_session
 from sqlalchemy.ext.declarative import declarative_base
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 _config = ConfigSection('staticdata')
 _log = logging.getLogger('sound.srp.be.staticdata')
 
 Base = declarative_base()
 engine = create_engine(_config.get_option('connection_string'))
-metadata = MetaData(bind = engine)
+_metadata_cache = _config.get_option('metadata_cache') or 'staticdata.metadata.pickle'
+
+def _schema_key():
+    """ Returns a hash of the connection string, the SQLAlchemy version and the columns of every table in
+    the database, so that a cached reflection is only used for the same schema.
+
+    This is a single query, where reflecting the tables takes several for each table.
+    """
+
+    with engine.connect() as connection:
+        if engine.dialect.name == 'sqlite':
+            rows = connection.execute("select name, sql from sqlite_master where type = 'table' order by name")
+        else:
+            rows = connection.execute(text('select table_name, column_name, data_type, is_nullable '
+                    'from information_schema.columns where table_schema = :schema '
+                    'order by table_name, ordinal_position'), schema = engine.dialect.default_schema_name)
+        schema = repr([tuple(row) for row in rows])
+    return hashlib.sha1('\n'.join([_config.get_option('connection_string'), sqlalchemy.__version__,
+            schema])).hexdigest()
+
+def _load_metadata(path, key):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = cPickle.load(f)
+    except Exception:
+        _log.warning('Could not read the reflected tables from %s, reflecting them again.', path, exc_info = True)
+        return None
+    if data['key'] != key:
+        _log.info('Reflected tables in %s are for another database or schema, reflecting them again.', path)
+        return None
+    data['metadata'].bind = engine
+    return data['metadata']
+
+def _save_metadata(path, key):
+    # Several jobs can start at once, so each writes its own file and renames it into place.
+    temp = '%s.%d.tmp' % (path, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            cPickle.dump({ 'key': key, 'metadata': metadata }, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(temp, path)
+        _log.debug('Saved %d reflected tables to %s.', len(metadata.tables), path)
+    except (IOError, OSError):
+        _log.warning('Could not save the reflected tables to %s.', path, exc_info = True)
+
+_metadata_key = _schema_key()
+metadata = _load_metadata(_metadata_cache, _metadata_key)
+if metadata is None:
+    metadata = MetaData(bind = engine)
+# Names of the tables that were not in the cached reflection.
+_reflected = []
+
+def _table(name):
+    """ Returns the Table for name, from the cached reflection when there is one. """
+
+    table = metadata.tables.get(name)
+    if table is None:
+        _log.debug('Reflecting table %s.', name)
+        table = Table(name, metadata, autoload = True)
+        _reflected.append(name)
+    return table
+
 session = create_session(bind = engine)
 cache = CacheManager(**parse_cache_config_options(
     { 'cache.type': _config.get_option('cache_type') }))
+_collection_cache_size = int(_config.get_option('collection_cache_size') or 1000)
+
+# [calls, misses, evictions] for each cache region. Calls that were not misses were hits.
+_cache_stats = {}
+
+def _cached(region):
+    """ Caches an accessor in the beaker cache like @cache.cache(region), counting its hits and misses. """
+
+    stats = _cache_stats.setdefault(region, [0, 0, 0])
+    def decorate(fn):
+        def load(*args):
+            stats[1] += 1
+            return fn(*args)
+        load.__name__ = fn.__name__
+        cached = cache.cache(region)(load)
+        def lookup(*args):
+            stats[0] += 1
+            return cached(*args)
+        lookup.__name__ = fn.__name__
+        lookup.__dict__.update(cached.__dict__)
+        return lookup
+    return decorate
+
+class _LruCache(object):
+    """ Least recently used cache of the results of an accessor, keyed by its arguments. """
+
+    def __init__(self, region, size):
+        self.size = size
+        self.stats = _cache_stats.setdefault(region, [0, 0, 0])
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            self.stats[0] += 1
+            if key in self._entries:
+                value = self._entries.pop(key)
+                self._entries[key] = value
+                return value
+            self.stats[1] += 1
+        value = load()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last = False)
+                self.stats[2] += 1
+        return value
+
+def _cached_tuple(region):
+    """ Caches the rows of a query returned by an accessor as a tuple, for at most
+    _collection_cache_size different arguments.
+
+    A query cached as it is runs its SQL again on every iteration, so the rows are read once here.
+    """
+
+    lru = _LruCache(region, _collection_cache_size)
+    def decorate(fn):
+        def lookup(*args):
+            return lru.get(args, lambda: tuple(fn(*args)))
+        lookup.__name__ = fn.__name__
+        return lookup
+    return decorate
+
+def cache_stats():
+    """ Returns (hits, misses, evictions) for each static data cache region. """
+
+    return dict((region, (calls - misses, misses, evictions))
+            for region, (calls, misses, evictions) in _cache_stats.iteritems())
+
+def log_cache_stats():
+    for region, (hits, misses, evictions) in sorted(cache_stats().iteritems()):
+        if hits or misses:
+            _log.info('Static data cache %s: %d hits, %d misses, %d evictions.', region, hits, misses, evictions)
+
+atexit.register(log_cache_stats)
+
+class _SnapshotTable(object):
+    """ The rows of one SDE table, indexed on first use of a column, and the objects made from them. """
+
+    def __init__(self, columns, rows):
+        self.columns = columns
+        self.rows = rows
+        self._indexes = {}
+        self._objects = {}
+
+    def get(self, cls, column, value):
+        index = self._indexes.get(column)
+        if index is None:
+            position = self.columns.index(column)
+            index = self._indexes[column] = {}
+            # Keep the first row for a value, as query(...).first() would.
+            for row_number in xrange(len(self.rows) - 1, -1, -1):
+                index[self.rows[row_number][position]] = row_number
+        row_number = index.get(value)
+        if row_number is None:
+            return None
+        obj = self._objects.get(row_number)
+        if obj is None:
+            obj = self._objects[row_number] = cls(**dict(zip(self.columns, self.rows[row_number])))
+        return obj
+
+# Tables kept in the snapshot, by mapped class name.
+_snapshot_classes = ('InvType', 'InvGroup', 'InvCategory', 'InvFlag', 'InvMarketGroup', 'MapRegion',
+        'MapConstellation', 'MapSolarSystem', 'DgmAttributeTypes', 'DgmEffects')
+_snapshot = None
+
+def _load_snapshot(path, version):
+    if not os.path.exists(path):
+        _log.warning('No static data snapshot at %s, using the database.', path)
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = cPickle.load(f)
+    except Exception:
+        _log.warning('Could not read the static data snapshot %s, removing it and using the database.',
+                path, exc_info = True)
+        try:
+            os.remove(path)
+        except OSError:
+            _log.warning('Could not remove the static data snapshot %s.', path, exc_info = True)
+        return None
+    if data['version'] != version:
+        _log.warning('Static data snapshot %s is for SDE %s, not %s, using the database.',
+                path, data['version'], version)
+        return None
+    _log.debug('Loaded static data snapshot %s for SDE %s.', path, version)
+    return dict((name, _SnapshotTable(columns, rows)) for name, (columns, rows) in data['tables'].iteritems())
+
+if _config.get_option('snapshot'):
+    _snapshot = _load_snapshot(_config.get_option('snapshot'), _config.get_option('sde_version'))
+
+def from_snapshot(class_name, column):
+    """ Serves a by_id or by_name accessor of class_name from the snapshot, when one is loaded.
+
+    column is the column that the argument of the accessor is matched against.
+    """
+
+    def decorate(fn):
+        def lookup(value):
+            if _snapshot is None:
+                return fn(value)
+            return _snapshot[class_name].get(globals()[class_name], column, value)
+        lookup.__name__ = fn.__name__
+        lookup.__dict__.update(fn.__dict__)
+        return lookup
+    return decorate
+
+def build_snapshot(path = None, version = None):
+    """ Writes the tables in _snapshot_classes from the database to a snapshot file. """
+
+    path = path or _config.get_option('snapshot')
+    version = version or _config.get_option('sde_version')
+    if not path or not version:
+        raise ValueError('The snapshot and sde_version options need to be set to build a snapshot.')
+    tables = {}
+    for name in _snapshot_classes:
+        table = globals()[name].__table__
+        columns = [column.name for column in table.columns]
+        rows = [tuple(row) for row in engine.execute(table.select())]
+        tables[name] = (columns, rows)
+        _log.info('Read %d rows of %s.', len(rows), table.name)
+    temp = path + '.tmp'
+    with open(temp, 'wb') as f:
+        cPickle.dump({ 'version': version, 'tables': tables }, f, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp, path)
+    _log.info('Wrote static data snapshot %s for SDE %s.', path, version)
+
+# Ids per IN query, under the 999 bound parameters that SQLite allows.
+_in_chunk_size = 500
+
+def _chunks(ids):
+    for start in xrange(0, len(ids), _in_chunk_size):
+        yield ids[start:start + _in_chunk_size]
+
+def _by_id_cache(cls):
+    return cache.get_cache(cls.by_id._arg_namespace)
+
+def _cache_by_id(cls, id, obj):
+    """ Stores obj as the result of cls.by_id(id), under the key that @cache.cache would use. """
+
+    _by_id_cache(cls).put(u'%s.by_id %s' % (cls.__name__, id), obj)
+
+def _cached_by_ids(cls, ids):
+    """ Returns the objects of cls already cached by by_id, by id, and a list of the ids that are not.
+
+    With a snapshot loaded every id is served from it, so none are left to query.
+    """
+
+    ids = set(ids)
+    if _snapshot is not None:
+        return dict((id, cls.by_id(id)) for id in ids), []
+    by_id = _by_id_cache(cls)
+    found = {}
+    missing = []
+    for id in ids:
+        try:
+            found[id] = by_id.get(u'%s.by_id %s' % (cls.__name__, id))
+        except KeyError:
+            missing.append(id)
+    return found, missing
+
+def _by_ids(cls, column, ids):
+    """ Gets the objects of cls with the given ids in as few IN queries as possible.
+
+    Returns a dict of the objects by id, with None for ids that do not exist. Everything that was
+    queried is put in the by_id cache of cls, so later by_id calls for these ids do not query again.
+    """
+
+    found, missing = _cached_by_ids(cls, ids)
+    for chunk in _chunks(missing):
+        for obj in session.query(cls).filter(getattr(cls, column).in_(chunk)):
+            found[getattr(obj, column)] = obj
+    for id in missing:
+        _cache_by_id(cls, id, found.setdefault(id, None))
+    return found
 
 class InvType(Base):
-    __table__ = Table('invTypes', metadata, autoload=True)
+    __table__ = _table('invTypes')
 
     @staticmethod
-    @cache.cache('InvType.by_id')
+    @from_snapshot('InvType', 'typeID')
+    @_cached('InvType.by_id')
     def by_id(type_id):
         _log.debug('Get InvType by id: %d' % type_id)
         return session.query(InvType).filter_by(typeID = type_id).first()
 
     @staticmethod
-    @cache.cache('InvType.by_name')
+    @from_snapshot('InvType', 'typeName')
+    @_cached('InvType.by_name')
     def by_name(type_name):
         _log.debug('Get InvType by name: %s' % type_name)
         return session.query(InvType).filter_by(typeName = type_name).first()
 
     @staticmethod
-    @cache.cache('InvType.by_group_id')
+    def by_ids(type_ids):
+        """ Gets InvTypes by id with their groups and categories, and caches all three by id. """
+
+        found, missing = _cached_by_ids(InvType, type_ids)
+        _log.debug('Get InvTypes by ids: %d cached, %d to query' % (len(found), len(missing)))
+        for chunk in _chunks(missing):
+            query = session.query(InvType, InvGroup, InvCategory) \
+                    .outerjoin(InvGroup, InvType.groupID == InvGroup.groupID) \
+                    .outerjoin(InvCategory, InvGroup.categoryID == InvCategory.categoryID) \
+                    .filter(InvType.typeID.in_(chunk))
+            for inv_type, group, category in query:
+                found[inv_type.typeID] = inv_type
+                if group is not None:
+                    _cache_by_id(InvGroup, group.groupID, group)
+                if category is not None:
+                    _cache_by_id(InvCategory, category.categoryID, category)
+        for type_id in missing:
+            _cache_by_id(InvType, type_id, found.setdefault(type_id, None))
+        return found
+
+    @staticmethod
+    @_cached_tuple('InvType.by_group_id')
     def by_group_id(group_id):
         _log.debug('Get InvTypes by group: %d' % group_id)
         return session.query(InvType).filter_by(groupID = group_id)
@@ -62,22 +376,29 @@ class InvType(Base):
         return InvMarketGroup.by_id(self.marketGroupID)
 
 class InvGroup(Base):
-    __table__ = Table('invGroups', metadata, autoload=True)
+    __table__ = _table('invGroups')
 
     @staticmethod
-    @cache.cache('InvGroup.by_id')
+    @from_snapshot('InvGroup', 'groupID')
+    @_cached('InvGroup.by_id')
     def by_id(group_id):
         _log.debug('Get InvGroup by id: %d' % group_id)
         return session.query(InvGroup).filter_by(groupID = group_id).first()
 
     @staticmethod
-    @cache.cache('InvGroup.by_name')
+    @from_snapshot('InvGroup', 'groupName')
+    @_cached('InvGroup.by_name')
     def by_name(group_name):
         _log.debug('Get InvGroup by name: %s' % group_name)
         return session.query(InvGroup).filter_by(groupName = group_name).first()
 
     @staticmethod
-    @cache.cache('InvGroup.by_category_id')
+    def by_ids(group_ids):
+        _log.debug('Get InvGroups by ids')
+        return _by_ids(InvGroup, 'groupID', group_ids)
+
+    @staticmethod
+    @_cached_tuple('InvGroup.by_category_id')
     def by_category_id(category_id):
         _log.debug('Get InvGroups by category: %d' % category_id)
         return session.query(InvGroup).filter_by(categoryID = category_id)
@@ -99,16 +420,18 @@ class InvGroup(Base):
         return InvType.by_group_id(self.groupID)
 
 class InvCategory(Base):
-    __table__ = Table('invCategories', metadata, autoload=True)
+    __table__ = _table('invCategories')
 
     @staticmethod
-    @cache.cache('InvCategory.by_id')
+    @from_snapshot('InvCategory', 'categoryID')
+    @_cached('InvCategory.by_id')
     def by_id(category_id):
         _log.debug('Get InvCategory by id: %d' % category_id)
         return session.query(InvCategory).filter_by(categoryID = category_id).first()
 
     @staticmethod
-    @cache.cache('InvCategory.by_name')
+    @from_snapshot('InvCategory', 'categoryName')
+    @_cached('InvCategory.by_name')
     def by_name(category_name):
         _log.debug('Get InvCategory by name: %s' % category_name)
         return session.query(InvCategory).filter_by(categoryName = category_name).first()
@@ -125,20 +448,27 @@ class InvCategory(Base):
         return InvGroup.by_category_id(self.categoryID)
 
 class InvFlag(Base):
-    __table__ = Table('invFlags', metadata, autoload=True)
+    __table__ = _table('invFlags')
 
     @staticmethod
-    @cache.cache('InvFlag.by_id')
+    @from_snapshot('InvFlag', 'flagID')
+    @_cached('InvFlag.by_id')
     def by_id(flag_id):
         _log.debug('Get InvFlag by id: %d' % flag_id)
         return session.query(InvFlag).filter_by(flagID = flag_id).first()
 
     @staticmethod
-    @cache.cache('InvFlag.by_name')
+    @from_snapshot('InvFlag', 'flagName')
+    @_cached('InvFlag.by_name')
     def by_name(flag_name):
         _log.debug('Get InvFlag by name: %s' % flag_name)
         return session.query(InvFlag).filter_by(flagName = flag_name).first()
 
+    @staticmethod
+    def by_ids(flag_ids):
+        _log.debug('Get InvFlags by ids')
+        return _by_ids(InvFlag, 'flagID', flag_ids)
+
     def __repr__(self):
         return 'InvFlag.by_id(%d)' % self.flagID
 
@@ -146,16 +476,18 @@ class InvFlag(Base):
         return self.flagName
 
 class InvMarketGroup(Base):
-    __table__ = Table('invMarketGroups', metadata, autoload=True)
+    __table__ = _table('invMarketGroups')
 
     @staticmethod
-    @cache.cache('InvMarketGroup.by_id')
+    @from_snapshot('InvMarketGroup', 'marketGroupID')
+    @_cached('InvMarketGroup.by_id')
     def by_id(market_group_id):
         _log.debug('Get InvMarketGroup by id: %d' % market_group_id)
         return session.query(InvMarketGroup).filter_by(marketGroupID = market_group_id).first()
 
     @staticmethod
-    @cache.cache('InvMarketGroup.by_name')
+    @from_snapshot('InvMarketGroup', 'marketGroupName')
+    @_cached('InvMarketGroup.by_name')
     def by_name(market_group_name):
         _log.debug('Get InvMarketGroup by name: %s' % market_group_name)
         return session.query(InvMarketGroup).filter_by(marketGroupName = market_group_name).first()
@@ -173,10 +505,10 @@ class InvMarketGroup(Base):
             return InvMarketGroup.by_id(self.parentGroupID)
 
 class InvTypeReaction(Base):
-    __table__ = Table('invTypeReactions', metadata, autoload=True)
+    __table__ = _table('invTypeReactions')
 
     @staticmethod
-    @cache.cache('InvTypeReaction.by_reaction_id')
+    @_cached_tuple('InvTypeReaction.by_reaction_id')
     def by_reaction_id(reaction_id):
         _log.debug('Get InvTypeReactions by reaction type: %d' % reaction_id)
         return session.query(InvTypeReaction).filter_by(reactionTypeID = reaction_id)
@@ -194,10 +526,10 @@ class InvTypeReaction(Base):
             return InvType.by_id(self.typeID)
 
 class InvControlTowerResource(Base):
-    __table__ = Table('invControlTowerResources', metadata, autoload=True)
+    __table__ = _table('invControlTowerResources')
 
     @staticmethod
-    @cache.cache('InvControlTowerResource.by_tower_type_id')
+    @_cached_tuple('InvControlTowerResource.by_tower_type_id')
     def by_tower_type_id(tower_id):
         _log.debug('Get InvControlTowerResource by tower type: %d' % tower_id)
         return session.query(InvControlTowerResource).filter_by(controlTowerTypeID = tower_id, minSecurityLevel = None)
@@ -215,16 +547,18 @@ class InvControlTowerResource(Base):
             return InvType.by_id(self.resourceTypeID)
 
 class MapRegion(Base):
-    __table__ = Table('mapRegions', metadata, autoload=True)
+    __table__ = _table('mapRegions')
 
     @staticmethod
-    @cache.cache('MapRegion.by_id')
+    @from_snapshot('MapRegion', 'regionID')
+    @_cached('MapRegion.by_id')
     def by_id(region_id):
         _log.debug('Get MapRegion by id: %d' % region_id)
         return session.query(MapRegion).filter_by(regionID = region_id).first()
 
     @staticmethod
-    @cache.cache('MapRegion.by_name')
+    @from_snapshot('MapRegion', 'regionName')
+    @_cached('MapRegion.by_name')
     def by_name(region_name):
         _log.debug('Get MapRegion by name: %s' % region_name)
         return session.query(MapRegion).filter_by(regionName = region_name).first()
@@ -236,16 +570,18 @@ class MapRegion(Base):
         return self.regionName
 
 class MapConstellation(Base):
-    __table__ = Table('mapConstellations', metadata, autoload=True)
+    __table__ = _table('mapConstellations')
 
     @staticmethod
-    @cache.cache('MapConstellation.by_id')
+    @from_snapshot('MapConstellation', 'constellationID')
+    @_cached('MapConstellation.by_id')
     def by_id(constellation_id):
         _log.debug('Get MapConstellation by id: %d' % constellation_id)
         return session.query(MapConstellation).filter_by(constellationID = constellation_id).first()
 
     @staticmethod
-    @cache.cache('MapConstellation.by_name')
+    @from_snapshot('MapConstellation', 'constellationName')
+    @_cached('MapConstellation.by_name')
     def by_name(constellation_name):
         _log.debug('Get MapConstellation by name: %s' % constellation_name)
         return session.query(MapConstellation).filter_by(constellationName = constellation_name).first()
@@ -262,20 +598,27 @@ class MapConstellation(Base):
         return MapRegion.by_id(self.regionID)
 
 class MapSolarSystem(Base):
-    __table__ = Table('mapSolarSystems', metadata, autoload=True)
+    __table__ = _table('mapSolarSystems')
 
     @staticmethod
-    @cache.cache('MapSolarSystem.by_id')
+    @from_snapshot('MapSolarSystem', 'solarSystemID')
+    @_cached('MapSolarSystem.by_id')
     def by_id(system_id):
         _log.debug('Get MapSolarSystem by id: %d' % system_id)
         return session.query(MapSolarSystem).filter_by(solarSystemID = system_id).first()
 
     @staticmethod
-    @cache.cache('MapSolarSystem.by_name')
+    @from_snapshot('MapSolarSystem', 'solarSystemName')
+    @_cached('MapSolarSystem.by_name')
     def by_name(system_name):
         _log.debug('Get MapSolarSystem by name: %s' % system_name)
         return session.query(MapSolarSystem).filter_by(solarSystemName = system_name).first()
 
+    @staticmethod
+    def by_ids(system_ids):
+        _log.debug('Get MapSolarSystems by ids')
+        return _by_ids(MapSolarSystem, 'solarSystemID', system_ids)
+
     def __repr__(self):
         return 'MapSolarSystem.by_id(%d)' % self.solarSystemID
 
@@ -295,22 +638,125 @@ class MapSolarSystem(Base):
     @property
     def neighbours(self):
         _log.debug('Get neighbouring systems for MapSolarSystem %s' % self)
-        return [MapSolarSystem.by_id(jump.toSolarSystemID) for jump in MapSolarSystemJumps.by_id(self.solarSystemID)]
+        system_ids = jump_graph().neighbours(self.solarSystemID)
+        systems = MapSolarSystem.by_ids(system_ids)
+        return [systems[system_id] for system_id in system_ids]
 
 class MapSolarSystemJumps(Base):
-    __table__ = Table('mapSolarSystemJumps', metadata, autoload=True)
+    __table__ = _table('mapSolarSystemJumps')
 
     @staticmethod
-    @cache.cache('MapSolarSystemJumps.by_id')
+    @_cached_tuple('MapSolarSystemJumps.by_id')
     def by_id(system_id):
         _log.debug('Get MapSolarSystemJumps by solar system id: %d' % system_id)
         return session.query(MapSolarSystemJumps).filter_by(fromSolarSystemID = system_id)
 
+class JumpGraph(object):
+    """ The stargate jumps between solar systems as compressed sparse row arrays.
+
+    Systems are numbered by their position in ids. The neighbours of system i are the systems
+    targets[offsets[i]:offsets[i + 1]]. Systems without stargates are not in the graph.
+    """
+
+    def __init__(self, jumps):
+        """ jumps is an iterable of (fromSolarSystemID, toSolarSystemID) pairs. """
+
+        jumps = sorted(set((int(from_id), int(to_id)) for from_id, to_id in jumps))
+        ids = sorted(set(from_id for from_id, _ in jumps) | set(to_id for _, to_id in jumps))
+        self.ids = array('i', ids)
+        self._positions = dict((system_id, position) for position, system_id in enumerate(ids))
+        self.offsets = array('i', [0] * (len(ids) + 1))
+        for from_id, _ in jumps:
+            self.offsets[self._positions[from_id] + 1] += 1
+        for position in xrange(len(ids)):
+            self.offsets[position + 1] += self.offsets[position]
+        self.targets = array('i', [self._positions[to_id] for _, to_id in jumps])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _neighbours(self, position):
+        return self.targets[self.offsets[position]:self.offsets[position + 1]]
+
+    def neighbours(self, system_id):
+        """ Returns the ids of the systems one jump from system_id. """
+
+        position = self._positions.get(system_id)
+        if position is None:
+            return []
+        return [self.ids[neighbour] for neighbour in self._neighbours(position)]
+
+    def within(self, system_id, jumps):
+        """ Returns the number of jumps to every system at most jumps away from system_id, by id. """
+
+        start = self._positions.get(system_id)
+        if start is None:
+            return { system_id: 0 }
+        distances = { start: 0 }
+        frontier = [start]
+        for distance in xrange(1, jumps + 1):
+            reached = []
+            for position in frontier:
+                for neighbour in self._neighbours(position):
+                    if neighbour not in distances:
+                        distances[neighbour] = distance
+                        reached.append(neighbour)
+            if not reached:
+                break
+            frontier = reached
+        return dict((self.ids[position], distance) for position, distance in distances.iteritems())
+
+    def route(self, from_id, to_id):
+        """ Returns the ids of the systems on a shortest route from from_id to to_id, both included,
+        or None if there is no route.
+        """
+
+        start = self._positions.get(from_id)
+        end = self._positions.get(to_id)
+        if start is None or end is None:
+            return [from_id] if from_id == to_id else None
+        previous = array('i', [-1]) * len(self.ids)
+        previous[start] = start
+        frontier = [start]
+        while frontier and previous[end] < 0:
+            reached = []
+            for position in frontier:
+                for neighbour in self._neighbours(position):
+                    if previous[neighbour] < 0:
+                        previous[neighbour] = position
+                        reached.append(neighbour)
+            frontier = reached
+        if previous[end] < 0:
+            return None
+        route = [end]
+        while route[-1] != start:
+            route.append(previous[route[-1]])
+        return [self.ids[position] for position in reversed(route)]
+
+    def distance(self, from_id, to_id):
+        """ Returns the number of jumps on a shortest route from from_id to to_id, or None if there is none. """
+
+        route = self.route(from_id, to_id)
+        return len(route) - 1 if route is not None else None
+
+_jump_graph = None
+
+def jump_graph():
+    """ Returns the JumpGraph of all stargates, read from mapSolarSystemJumps on first use. """
+
+    global _jump_graph
+    if _jump_graph is None:
+        table = MapSolarSystemJumps.__table__
+        rows = engine.execute(select([table.c.fromSolarSystemID, table.c.toSolarSystemID]))
+        _jump_graph = JumpGraph(tuple(row) for row in rows)
+        _log.debug('Loaded jump graph of %d systems and %d jumps.', len(_jump_graph), len(_jump_graph.targets))
+    return _jump_graph
+
 class MapDenormalize(Base):
-    __table__ = Table('mapDenormalize', metadata, autoload=True)
+    __table__ = _table('mapDenormalize')
 
     @staticmethod
-    @cache.cache('MapDenormalize.by_id')
+    @_cached('MapDenormalize.by_id')
     def by_id(item_id):
         _log.debug('Get MapDenormalize by id: %d' % item_id)
         return session.query(MapDenormalize).filter_by(itemID = item_id).first()
@@ -352,16 +798,18 @@ class MapDenormalize(Base):
             return MapDenormalize.by_id(self.orbitID)
 
 class DgmAttributeTypes(Base):
-    __table__ = Table('dgmAttributeTypes', metadata, autoload=True)
+    __table__ = _table('dgmAttributeTypes')
 
     @staticmethod
-    @cache.cache('DgmAttributeTypes.by_id')
+    @from_snapshot('DgmAttributeTypes', 'attributeID')
+    @_cached('DgmAttributeTypes.by_id')
     def by_id(attribute_id):
         _log.debug('Get DgmAttributeTypes by id: %d' % attribute_id)
         return session.query(DgmAttributeTypes).filter_by(attributeID = attribute_id).first()
 
     @staticmethod
-    @cache.cache('DgmAttributeTypes.by_name')
+    @from_snapshot('DgmAttributeTypes', 'attributeName')
+    @_cached('DgmAttributeTypes.by_name')
     def by_name(attribute_name):
         _log.debug('Get DgmAttributeTypes by name: %s' % attribute_name)
         return session.query(DgmAttributeTypes).filter_by(attributeName = attribute_name).first()
@@ -379,10 +827,10 @@ class DgmAttributeTypes(Base):
         return self.for_type_id(InvType.by_name(type_name).typeID)
 
 class DgmTypeAttributes(Base):
-    __table__ = Table('dgmTypeAttributes', metadata, autoload=True)
+    __table__ = _table('dgmTypeAttributes')
 
     @staticmethod
-    @cache.cache('DgmTypeAttributes.by_ids')
+    @_cached('DgmTypeAttributes.by_ids')
     def by_ids(type_id, attribute_id):
         _log.debug('Get DgmTypeAttributes by ids: %d, %d' % (type_id, attribute_id))
         result = session.query(DgmTypeAttributes).filter_by(
@@ -392,16 +840,18 @@ class DgmTypeAttributes(Base):
         return None
 
 class DgmEffects(Base):
-    __table__ = Table('dgmEffects', metadata, autoload=True)
+    __table__ = _table('dgmEffects')
 
     @staticmethod
-    @cache.cache('DgmEffects.by_id')
+    @from_snapshot('DgmEffects', 'effectID')
+    @_cached('DgmEffects.by_id')
     def by_id(effect_id):
         _log.debug('Get DgmEffects by id: %d' % effect_id)
         return session.query(DgmEffects).filter_by(effectID = effect_id).first()
 
     @staticmethod
-    @cache.cache('DgmEffects.by_name')
+    @from_snapshot('DgmEffects', 'effectName')
+    @_cached('DgmEffects.by_name')
     def by_name(effect_name):
         _log.debug('Get DgmEffects by name: %s' % effect_name)
         return session.query(DgmEffects).filter_by(effectName = effect_name).first()
@@ -419,10 +869,10 @@ class DgmEffects(Base):
         return self.for_type_id(InvType.by_name(type_name).typeID)
 
 class DgmTypeEffects(Base):
-    __table__ = Table('dgmTypeEffects', metadata, autoload=True)
+    __table__ = _table('dgmTypeEffects')
 
     @staticmethod
-    @cache.cache('DgmTypeEffects.by_ids')
+    @_cached('DgmTypeEffects.by_ids')
     def by_ids(type_id, effect_id):
         _log.debug('Get DgmTypeEffects by ids: %d, %d' % (type_id, effect_id))
         result = session.query(DgmTypeEffects).filter_by(
@@ -431,3 +881,105 @@ class DgmTypeEffects(Base):
             return result.isDefault
         return None
 
+if _reflected:
+    _save_metadata(_metadata_cache, _metadata_key)
+
+class DogmaIndex(object):
+    """ The values of some dogma attributes and the types with some dogma effects, held in sorted arrays
+    of typeIDs so that whole lists of types can be looked up at once.
+
+        index = DogmaIndex(['lowSlots', 'upgradeCost'], ['turretFitted'])
+        index.attribute('lowSlots', ship_type_id)
+        sum(index.attributes('upgradeCost', rig_type_ids))
+        sum(index.has_effects('turretFitted', high_slot_type_ids))
+
+    Uses NumPy when it is installed, otherwise the same lookups are made with bisect over arrays. Either
+    way the results are plain Python values, so they can be stored in the datastore.
+    As with DgmTypeAttributes.by_ids, valueFloat is used when it is set and valueInt otherwise.
+    """
+
+    def __init__(self, attribute_names = (), effect_names = ()):
+        self._attributes = {}
+        self._effects = {}
+        attribute_ids = dict((DgmAttributeTypes.by_name(name).attributeID, name) for name in attribute_names)
+        effect_ids = dict((DgmEffects.by_name(name).effectID, name) for name in effect_names)
+        values = dict((name, ([], [])) for name in attribute_names)
+        if attribute_ids:
+            table = DgmTypeAttributes.__table__
+            rows = engine.execute(select([table.c.attributeID, table.c.typeID, table.c.valueInt, table.c.valueFloat])
+                    .where(table.c.attributeID.in_(attribute_ids.keys()))
+                    .order_by(table.c.attributeID, table.c.typeID))
+            for attribute_id, type_id, value_int, value_float in rows:
+                type_ids, type_values = values[attribute_ids[attribute_id]]
+                type_ids.append(type_id)
+                type_values.append(value_float or value_int or 0)
+        for name, (type_ids, type_values) in values.iteritems():
+            self._attributes[name] = (self._ids(type_ids), self._values(type_values))
+        types = dict((name, []) for name in effect_names)
+        if effect_ids:
+            table = DgmTypeEffects.__table__
+            rows = engine.execute(select([table.c.effectID, table.c.typeID])
+                    .where(table.c.effectID.in_(effect_ids.keys()))
+                    .order_by(table.c.effectID, table.c.typeID))
+            for effect_id, type_id in rows:
+                types[effect_ids[effect_id]].append(type_id)
+        for name, type_ids in types.iteritems():
+            self._effects[name] = self._ids(type_ids)
+        _log.debug('Indexed %d dogma attributes and %d effects.', len(self._attributes), len(self._effects))
+
+    @staticmethod
+    def _ids(type_ids):
+        return numpy.array(type_ids, dtype = numpy.int64) if numpy else array('i', type_ids)
+
+    @staticmethod
+    def _values(values):
+        return numpy.array(values, dtype = numpy.float64) if numpy else array('d', values)
+
+    @staticmethod
+    def _positions(ids, type_ids):
+        """ Returns where each of type_ids is in ids, and whether it was found there. """
+
+        if numpy:
+            type_ids = numpy.asarray(type_ids, dtype = numpy.int64)
+            positions = numpy.minimum(numpy.searchsorted(ids, type_ids), max(len(ids) - 1, 0))
+            if not len(ids):
+                return positions, numpy.zeros(len(type_ids), dtype = bool)
+            return positions, ids[positions] == type_ids
+        positions = [bisect.bisect_left(ids, type_id) for type_id in type_ids]
+        found = [position < len(ids) and ids[position] == type_id for position, type_id in zip(positions, type_ids)]
+        return positions, found
+
+    def attribute(self, name, type_id, default = None):
+        """ Returns the value of attribute name for a type, or default if the type does not have it. """
+
+        ids, values = self._attributes[name]
+        position = bisect.bisect_left(ids, type_id)
+        if position < len(ids) and ids[position] == type_id:
+            return float(values[position])
+        return default
+
+    def attributes(self, name, type_ids, default = 0.0):
+        """ Returns a list of the values of attribute name for a list of types, with default for types
+        without it.
+        """
+
+        ids, values = self._attributes[name]
+        positions, found = self._positions(ids, type_ids)
+        if numpy:
+            return numpy.where(found, values[positions] if len(values) else default, default).tolist()
+        return [values[position] if present else default for position, present in zip(positions, found)]
+
+    def has_effect(self, name, type_id):
+        ids = self._effects[name]
+        position = bisect.bisect_left(ids, type_id)
+        return bool(position < len(ids) and ids[position] == type_id)
+
+    def has_effects(self, name, type_ids):
+        """ Returns a list of whether each of a list of types has effect name. """
+
+        found = self._positions(self._effects[name], type_ids)[1]
+        return found.tolist() if numpy else found
+
+if __name__ == '__main__':
+    if 'snapshot' in sys.argv:
+        build_snapshot()
@@ -1,15 +1,12 @@
-from datastore import *
+import sys
+from datastore import KillMail
+from migration import Migration, key_shards
 
-kms = KillMail.all_after(45547000)
-tosave = []
-for km in kms:
-  if km.final_blow is None:
-      print km
-      km.final_blow = filter(lambda a: a.final_blow, km.attackers)
-      tosave.append(km)
-      if len(tosave) >= 5:
-          KillMail.bulk_save(tosave)
-          tosave = []
-if len(tosave) > 0:
-    KillMail.bulk_save(tosave)
+def fix_final_blow(km):
+    if km.final_blow is None:
+        km.final_blow = next((a for a in km.attackers if a.final_blow), None)
 
+if __name__ == '__main__':
+    # The highest kill id to fix is given on the command line, as key_shards needs an end.
+    last_kill_id = int(sys.argv[1])
+    Migration('fix_final_blow', KillMail, fix_final_blow, key_shards(KillMail, 8, 45547001, last_kill_id)).run()
@@ -4,7 +4,7 @@ import logging
 import market
 import valuer
 from config import ConfigSection
-from datastore import KillMail, Victim, Attacker, Item, GroupedItems, ShipClass, Character
+from datastore import KillMail, Victim, Attacker, Item, ShipClass, Session, SrpTotals
 from datetime import datetime, timedelta
 from eveapi import get_api_key
 from evelink.corp import Corp
@@ -20,7 +20,7 @@ def get_api_keys():
 def get_new_kills(all_kills):
     _log.info('Filtering out kills that are already in the datastore.')
     ids = set(all_kills.keys())
-    old_ids = set(map((lambda k: k.kill_id), KillMail.load_multi(ids)))
+    old_ids = KillMail.exists_multi(ids)
     new_ids = ids.difference(old_ids)
     return [ all_kills[id] for id in new_ids ]
 
@@ -38,6 +38,25 @@ def get_ship_class(ship):
         return 'Pirate ' + groupName
     return groupName
 
+def prefetch_static_data(kills):
+    """ Loads the types, flags and systems of a page of kills in a few queries, so that converting
+    them finds everything in the static data caches.
+    """
+
+    type_ids = set()
+    flag_ids = set()
+    for kill in kills:
+        type_ids.add(kill['victim']['ship_type_id'])
+        for attacker in kill['attackers'].values():
+            type_ids.add(attacker['ship_type_id'])
+            type_ids.add(attacker['weapon_type_id'])
+        for item in kill['items']:
+            type_ids.add(item['id'])
+            flag_ids.add(item['flag'])
+    InvType.by_ids(type_ids)
+    InvFlag.by_ids(flag_ids)
+    MapSolarSystem.by_ids(kill['system_id'] for kill in kills)
+
 def convert_killmail(kill):
     km = KillMail()
     km.kill_id = kill['id']
@@ -54,7 +73,6 @@ def convert_killmail(kill):
     if km.final_blow is not None and type(km.final_blow) is list and len(km.final_blow) >= 1:
         km.final_blow = km.final_blow[0]
     km.items = map(convert_item, kill['items'])
-    km.grouped_items = GroupedItems(km.items)
     km.loss_mail = km.victim.alliance_id == alliance_id
     ship_class = ShipClass(km.victim.ship_class)
     km.default_payment = 0
@@ -144,23 +162,17 @@ def import_kills():
             minId = min(kills.keys())
             minDate = datetime.utcfromtimestamp(kills[minId]['time'])
             kills = get_new_kills(kills)
+            prefetch_static_data(kills)
             kills = map(convert_killmail, kills)
             _log.info('Importing %d kills.' % len(kills))
-            for kill in kills:
-                kill.save()
-                if kill.final_blow is None:
-                    fixers.append(crest)
-                if kill.loss_mail and kill.victim.character_id and kill.victim.character_id not in chars:
-                    chars.add(kill.victim.character_id)
-                    c = Character(kill.victim.character_id)
-                    c.character_name = kill.victim.character_name
-                    c.corp_id = kill.victim.corporation_id
-                    c.corp_name = kill.victim.corporation_name
-                    c.alliance_id = kill.victim.alliance_id
-                    c.alliance_name = kill.victim.alliance_name
-                    if c.declined_srp is None:
-                        c.declined_srp = False
-                    c.save()
+            with Session():
+                for kill in kills:
+                    if kill.final_blow is None:
+                        fixers.append(crest)
+                    new_char = kill.loss_mail and kill.victim.character_id and kill.victim.character_id not in chars
+                    if new_char:
+                        chars.add(kill.victim.character_id)
+                    SrpTotals.save_kill(kill, update_character = new_char)
             if minDate > start_time:
                 kills = corp.kills(before_kill = minId).result
             else:
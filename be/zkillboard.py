@@ -6,7 +6,7 @@ import sha
 import valuer
 import web
 from config import ConfigSection
-from datastore import KillMail, Victim, Attacker, Item, GroupedItems, ShipClass, Character
+from datastore import KillMail, Victim, Attacker, Item, ShipClass, Session, SrpTotals
 from datetime import datetime, timedelta
 from staticdata import MapSolarSystem, InvType, InvFlag
 
@@ -59,7 +59,7 @@ def get_kills(start_time):
 def get_new_kills(all_kills):
     _log.info('Filtering out kills that are already in the datastore.')
     ids = set([int(kill['killID']) for kill in all_kills if 'killID' in kill])
-    old_ids = set([k.kill_id for k in KillMail.load_multi(ids)])
+    old_ids = KillMail.exists_multi(ids)
     new_ids = ids.difference(old_ids)
     return filter((lambda k: int(k['killID']) in new_ids), all_kills)
 
@@ -77,6 +77,25 @@ def get_ship_class(ship):
         return 'Pirate ' + groupName
     return groupName
 
+def prefetch_static_data(kills):
+    """ Loads the types, flags and systems of a page of kills in a few queries, so that converting
+    them finds everything in the static data caches.
+    """
+
+    type_ids = set()
+    flag_ids = set()
+    for kill in kills:
+        type_ids.add(int(kill['victim']['shipTypeID']))
+        for attacker in kill['attackers']:
+            type_ids.add(int(attacker['shipTypeID']))
+            type_ids.add(int(attacker['weaponTypeID']))
+        for item in kill['items']:
+            type_ids.add(int(item['typeID']))
+            flag_ids.add(int(item['flag']))
+    InvType.by_ids(type_ids)
+    InvFlag.by_ids(flag_ids)
+    MapSolarSystem.by_ids(int(kill['solarSystemID']) for kill in kills)
+
 def convert_killmail(kill):
     km = KillMail()
     km.kill_id = int(kill['killID'])
@@ -93,7 +112,6 @@ def convert_killmail(kill):
     if type(km.final_blow) == list and len(km.final_blow) >= 1:
         km.final_blow = km.final_blow[0]
     km.items = map(convert_item, kill['items'])
-    km.grouped_items = GroupedItems(km.items)
     km.loss_mail = km.victim.alliance_id == alliance_id
     ship_class = ShipClass(km.victim.ship_class)
     km.default_payment = 0
@@ -174,21 +192,15 @@ def import_kills():
     _log.debug('Checking %d kills.' % len(kills))
     kills = get_new_kills(kills)
     _log.info('Importing %d kills.' % len(kills))
+    prefetch_static_data(kills)
     kills = map(convert_killmail, kills)
     chars = set()
-    for kill in kills:
-        kill.save()
-        if kill.victim.character_id and kill.victim.character_id not in chars:
-            chars.add(kill.victim.character_id)
-            c = Character(kill.victim.character_id)
-            c.character_name = kill.victim.character_name
-            c.corp_id = kill.victim.corporation_id
-            c.corp_name = kill.victim.corporation_name
-            c.alliance_id = kill.victim.alliance_id
-            c.alliance_name = kill.victim.alliance_name
-            if c.declined_srp is None:
-                c.declined_srp = False
-            c.save()
+    with Session():
+        for kill in kills:
+            new_char = kill.victim.character_id and kill.victim.character_id not in chars
+            if new_char:
+                chars.add(kill.victim.character_id)
+            SrpTotals.save_kill(kill, update_character = new_char)
 
 if __name__ == '__main__':
     import_kills()
@@ -12,7 +12,7 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from google.appengine.ext import ndb
 import simplejson as json
-from model import Configuration, Payment, Character, KillMail, LossMailAttributes, Tower, PosOwner, Corporation
+from model import Configuration, Payment, Character, KillMail, LossMailAttributes, Tower, PosOwner, Corporation, srp_owners
 from webapp2_extras import routes, sessions
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
@@ -183,32 +183,67 @@ class IGBPaymentsHandler(BaseHandler):
         template = JINJA_ENVIRONMENT.get_template('igbpayments.html')
         self.response.write(template.render(data))
 
+# A payment is marked paid in one cross group transaction with its character, corporation and killmails,
+# which may touch 25 entity groups; the payment consolidator keeps payments within this many losses.
+_max_payment_losses = 22
+
+def _pay_losses(losses, by_id):
+    kills = ndb.get_multi([ndb.Key(KillMail, loss.kill_id) for loss in losses])
+    for loss, kill in zip(losses, kills):
+        kill.paid_amount = (kill.paid_amount or 0) + loss.amount
+        kill.paid = kill.paid_amount == (kill.srp_amount or 0)
+        kill.modified_time = datetime.utcnow()
+        kill.modified_by = by_id
+    return kills
+
+@ndb.transactional(xg = True)
+def _mark_paid(payment_id, by_id, by_name):
+    """ Marks a payment as paid, adding it to the SRP totals of its owners and the paid amounts of its
+    killmails in the same commit. Returns False if it was already paid.
+    """
+
+    payment = Payment.get_by_id(payment_id)
+    if payment.paid:
+        return False
+    owners = srp_owners(payment.character_id, payment.corp_id)
+    for owner in owners:
+        owner.add_payment(payment.payment_amount or 0)
+    payment.paid = True
+    payment.paid_by = by_id
+    payment.paid_by_name = by_name
+    payment.paid_date = datetime.utcnow()
+    payment.modified_time = datetime.utcnow()
+    payment.modified_by = by_id
+    ndb.put_multi([payment] + owners + _pay_losses(payment.losses, by_id))
+    return True
+
+@ndb.transactional(xg = True)
+def _update_kill(kill_id, loss_type, srp_amount, by_id):
+    # TODO: Figure out where the [None] is coming from this time.
+    km = KillMail.get_by_id(kill_id)
+    km.payments = [p for p in km.payments if p is not None]
+    km.loss_type = loss_type
+    owners = []
+    if km.loss_mail and srp_amount != (km.srp_amount or 0):
+        owners = srp_owners(km.victim.character_id, km.victim.corporation_id)
+        for owner in owners:
+            owner.add_srp(srp_amount - (km.srp_amount or 0))
+    km.srp_amount = srp_amount
+    km.modified_time = datetime.utcnow()
+    km.modified_by = by_id
+    ndb.put_multi([km] + owners)
+
 class IGBPayHandler(BaseHandler):
-    @ndb.toplevel
     def get(self, payment_id):
         if not self.logged_in or not self.srp_payer:
             self.session['referer'] = webapp2.uri_for('igbpayments')
             return self.redirect_to('login')
+        payment_id = int(payment_id)
         _log.info('Setting payment %d as paid.' % payment_id)
-        payment = Payment.get_by_id(int(payment_id))
-        payment.paid = True
-        payment.paid_by = self.session['character_id']
-        payment.paid_by_name = self.session['character_name']
-        payment.paid_date = datetime.utcnow()
-        payment.modified_time = datetime.utcnow()
-        payment.modified_by = self.session['character_id']
-        payment.put_async()
-
-        loss_futures = [ (KillMail.query(KillMail.kill_id == loss.kill_id).get_async(), loss.amount)
-                for loss in payment.losses ]
-        for future, amount in loss_futures:
-            loss = future.get_result()
-            loss.paid_amount = (loss.paid_amount or 0) + amount
-            loss.paid = loss.paid_amount == (loss.srp_amount or 0)
-            loss.modified_time = datetime.utcnow()
-            loss.modified_by = self.session['character_id']
-            loss.put_async()
-
+        if len(Payment.get_by_id(payment_id).losses) > _max_payment_losses:
+            _log.error('Payment %d has too many losses to pay at once; it will be split on the next consolidation.' % payment_id)
+            self.abort(409)
+        _mark_paid(payment_id, self.session['character_id'], self.session['character_name'])
         self.redirect_to('igbpayments')
 
 class JsonHandler(BaseHandler):
@@ -312,15 +347,8 @@ class KillsHandler(JsonHandler):
         if not self.srp_admin:
             return self.redirect_to('srp')
         data = self.read_json()
-        kill_id = int(data['kill_id'])
-        # TODO: Figure out where the [None] is coming from this time.
-        km = KillMail.get_by_id(kill_id)
-        km.payments = [p for p in km.payments if p is not None]
-        km.loss_type = data['loss_type']
-        km.srp_amount = int(data['srp_amount'])
-        km.modified_time = datetime.utcnow()
-        km.modified_by = self.session['character_id']
-        km.put()
+        _update_kill(int(data['kill_id']), data['loss_type'], int(data['srp_amount']),
+                self.session['character_id'])
 
 class KillHandler(JsonHandler):
     def get(self, kill_id):
@@ -1,4 +1,6 @@
+import json
 import logging
+import zlib
 from datetime import datetime, timedelta
 from google.appengine.api.modules import get_current_version_name
 from google.appengine.ext import ndb
@@ -31,6 +33,41 @@ class LocalStructuredProperty(ndb.LocalStructuredProperty):
             value = val
         self._store_value(entity, value)
 
+# Start of a packed sub entity blob written by the backend, the last byte is the format version.
+# The format is defined in be/datastore.py: zlib compressed JSON, with each entity written as the
+# list of field names under 'f' and a row of values per entity under 'r'.
+_PACKED_HEADER = 'SRPK\x01'
+
+def _unpack(modelclass, packed):
+    if isinstance(packed, list):
+        return packed
+    names = [str(name) for name in packed['f']]
+    entities = []
+    for row in packed['r']:
+        e = modelclass()
+        for name, val in zip(names, row):
+            prop = modelclass._properties.get(name)
+            if prop is None or val is None:
+                continue
+            if isinstance(val, dict):
+                val = _unpack(prop._modelclass, val)
+            prop._set_value(e, val)
+        entities.append(e)
+    if packed.get('one'):
+        return entities[0]
+    return entities
+
+class PackedLocalStructuredProperty(LocalStructuredProperty):
+    # Also reads the packed format the backend can write for large sub entity lists, as well as
+    # the normal format. Values are always written in the normal format.
+    def _deserialize(self, entity, p, unused_depth=1):
+        v = p.value()
+        if v.has_stringvalue() and v.stringvalue().startswith(_PACKED_HEADER):
+            packed = json.loads(zlib.decompress(v.stringvalue()[len(_PACKED_HEADER):]))
+            self._store_value(entity, _unpack(self._modelclass, packed))
+            return
+        LocalStructuredProperty._deserialize(self, entity, p, unused_depth)
+
 class Configuration(ndb.Model):
     _CACHE_TIME = timedelta(minutes = 5)
     _VERSION = get_current_version_name()
@@ -57,15 +94,31 @@ class Configuration(ndb.Model):
             cls._INSTANCE_AGE = now
         return cls._INSTANCE
 
-class Corporation(ndb.Model):
+class SrpTotals(object):
+    """ Running SRP totals, in millions of ISK except isk_lost. Losses are counted by the importers. """
+
+    def add_srp(self, amount):
+        self.srp_requested = (self.srp_requested or 0) + amount
+        self.payments_owed = (self.payments_owed or 0) + amount
+
+    def add_payment(self, amount):
+        self.payments_made = (self.payments_made or 0) + amount
+        self.payments_owed = (self.payments_owed or 0) - amount
+
+class Corporation(SrpTotals, ndb.Model):
     corp_id = ndb.IntegerProperty()
     corp_name = ndb.StringProperty()
     alliance_id = ndb.IntegerProperty()
     alliance_name = ndb.StringProperty()
     srp = ndb.BooleanProperty()
     corp_ticker = ndb.StringProperty()
+    losses = ndb.IntegerProperty()
+    isk_lost = ndb.FloatProperty()
+    srp_requested = ndb.IntegerProperty()
+    payments_made = ndb.IntegerProperty()
+    payments_owed = ndb.IntegerProperty()
 
-class Character(ndb.Model):
+class Character(SrpTotals, ndb.Model):
     character_id = ndb.IntegerProperty()
     character_name = ndb.StringProperty()
     corp_id = ndb.IntegerProperty()
@@ -73,9 +126,22 @@ class Character(ndb.Model):
     alliance_id = ndb.IntegerProperty()
     alliance_name = ndb.StringProperty()
     declined_srp = ndb.BooleanProperty()
+    losses = ndb.IntegerProperty()
+    isk_lost = ndb.FloatProperty()
+    srp_requested = ndb.IntegerProperty()
     payments_made = ndb.IntegerProperty()
     payments_owed = ndb.IntegerProperty()
 
+def srp_owners(character_id, corp_id):
+    """ Get the stored Character and Corporation whose SRP totals a loss or payment counts towards. """
+
+    keys = []
+    if character_id:
+        keys.append(ndb.Key(Character, character_id))
+    if corp_id:
+        keys.append(ndb.Key(Corporation, corp_id))
+    return [owner for owner in ndb.get_multi(keys) if owner is not None]
+
 class Victim(ndb.Model):
     character_id = ndb.IntegerProperty()
     character_name = ndb.StringProperty()
@@ -132,6 +198,41 @@ class GroupedItems(ndb.Model):
     specialized_hangar = LocalStructuredProperty(Item, repeated = True)
     implants = LocalStructuredProperty(Item, repeated = True)
 
+# Slot list for each item flag name prefix, the same grouping as GroupedItems in be/datastore.py.
+_slot_prefixes = (
+    ('HiSlot', 'highs'),
+    ('MedSlot', 'mids'),
+    ('LoSlot', 'lows'),
+    ('RigSlot', 'rigs'),
+    ('SubSystem', 'subsystems'),
+    ('DroneBay', 'drone_bay'),
+    ('Cargo', 'cargo'),
+    ('FleetHangar', 'fleet_hangar'),
+    ('Specialized', 'specialized_hangar'),
+    ('Implant', 'implants')
+)
+# Slot list for each flag name seen so far, None for flags that are not in any slot.
+_flag_slots = {}
+
+def _slot(flag_name):
+    if flag_name not in _flag_slots:
+        _flag_slots[flag_name] = None
+        for prefix, name in _slot_prefixes:
+            if flag_name is not None and flag_name.startswith(prefix):
+                _flag_slots[flag_name] = name
+                break
+    return _flag_slots[flag_name]
+
+def group_items(items):
+    """ Groups item dictionaries by slot, ordered by flag with charges after their module. """
+
+    grouped = { name: [] for prefix, name in _slot_prefixes }
+    for item in sorted(items, key = lambda i: (i.flag_name, i.category_name == 'Charge')):
+        slot = _slot(item.flag_name)
+        if slot is not None:
+            grouped[slot].append(item.to_dict())
+    return grouped
+
 class PaymentDetail(ndb.Model):
     payment_id = ndb.IntegerProperty()
     kill_id = ndb.IntegerProperty()
@@ -145,10 +246,11 @@ class KillMail(ndb.Model):
     region_name = ndb.StringProperty()
     victim = LocalStructuredProperty(Victim)
     victim_id = ndb.IntegerProperty()
-    attackers = LocalStructuredProperty(Attacker, repeated = True)
+    attackers = PackedLocalStructuredProperty(Attacker, repeated = True)
     final_blow = LocalStructuredProperty(Attacker)
-    items = LocalStructuredProperty(Item, repeated = True)
-    grouped_items = LocalStructuredProperty(GroupedItems)
+    items = PackedLocalStructuredProperty(Item, repeated = True)
+    # No longer written, grouped items are worked out from items. Only older killmails have it.
+    grouped_items = PackedLocalStructuredProperty(GroupedItems)
     loss_mail = ndb.BooleanProperty()
     default_payment = ndb.IntegerProperty()
     suggested_loss_type = ndb.StringProperty()
@@ -168,6 +270,14 @@ class KillMail(ndb.Model):
     modified_by = ndb.IntegerProperty()
     srp_checked = ndb.BooleanProperty()
 
+    def _pre_put_hook(self):
+        self.grouped_items = None
+
+    def to_dict(self):
+        ds = super(KillMail, self).to_dict()
+        ds['grouped_items'] = group_items(self.items)
+        return ds
+
 class LossMailAttributes(ndb.Model):
     kill_id = ndb.IntegerProperty()
     character_id = ndb.IntegerProperty()
@@ -275,6 +385,7 @@ class Tower(ndb.Model):
     stront_bay_capacity = ndb.IntegerProperty()
     guns = LocalStructuredProperty(Silo, repeated = True)
     deleted = ndb.BooleanProperty()
+    jumps_to_staging = ndb.IntegerProperty()
 
     def to_dict(self):
         ds = super(Tower, self).to_dict()